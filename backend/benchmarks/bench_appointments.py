@@ -0,0 +1,55 @@
+"""Latencia de la verificación de citas con el índice de intervalos.
+
+Uso:
+    python backend/benchmarks/bench_appointments.py [--appointments 50000] [--drivers 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--appointments", type=int, default=50_000)
+    parser.add_argument("--drivers", type=int, default=20_000)
+    parser.add_argument("--lookups", type=int, default=100_000)
+    args = parser.parse_args()
+
+    # main.py crea data/ y static/ en el directorio actual: usar uno temporal
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, BACKEND_DIR)
+    from main import AppointmentIndex
+
+    random.seed(1)
+    day = datetime(2025, 6, 6)
+    codes = [f"{i:012x}" for i in range(args.drivers)]
+
+    start = time.perf_counter()
+    index = AppointmentIndex()
+    for _ in range(args.appointments):
+        begin = day + timedelta(minutes=random.randrange(0, 24 * 60, 15))
+        index.add(random.choice(codes), begin, begin + timedelta(minutes=random.choice([30, 60, 90])))
+    index.build()
+    build_time = time.perf_counter() - start
+
+    tolerance = timedelta(minutes=15)
+    queries = [(random.choice(codes), day + timedelta(seconds=random.randrange(86400)))
+               for _ in range(args.lookups)]
+    start = time.perf_counter()
+    for code, moment in queries:
+        index.check(code, moment, tolerance)
+    lookup_time = time.perf_counter() - start
+
+    print(f"Citas: {args.appointments:,} para {args.drivers:,} choferes")
+    print(f"  construcción del índice  {build_time * 1000:8.1f} ms")
+    print(f"  verificación promedio    {lookup_time / args.lookups * 1e6:8.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
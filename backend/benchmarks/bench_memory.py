@@ -0,0 +1,69 @@
+"""Memoria residente (RSS) de registros de entrada: diccionarios vs LogEntry.
+
+Uso:
+    python backend/benchmarks/bench_memory.py [--count 1000000]
+
+Cada variante se mide en un subproceso propio para que la memoria de una
+no contamine la otra.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def rss_mb():
+    # /proc/self/statm: tamaño total y residente en páginas
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def build_entries(mode, count):
+    # main.py crea data/ y static/ en el directorio actual: usar uno temporal
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, BACKEND_DIR)
+    from main import LogEntry
+
+    baseline = rss_mb()
+    entries = []
+    for i in range(count):
+        data = {
+            "timestamp": f"2025-06-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{i % 60:02d}",
+            "driver_name": f"Chofer {i % 5000}",
+            "qr_code": f"{i:012x}",
+            "status": "Entrada válida" if i % 10 else "QR inválido",
+            "notes": "QR generado el 2025-06-06T14:18:12.578928"
+        }
+        entries.append(data if mode == "dict" else LogEntry.from_dict(data))
+    return rss_mb() - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument("--mode", choices=["dict", "slots"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(f"{build_entries(args.mode, args.count):.1f}")
+        return
+
+    results = {}
+    for mode in ("dict", "slots"):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode, "--count", str(args.count)]
+        )
+        results[mode] = float(output.decode().strip())
+
+    print(f"Registros en memoria: {args.count:,}")
+    print(f"  dict       {results['dict']:8.1f} MB")
+    print(f"  LogEntry   {results['slots']:8.1f} MB")
+    print(f"  Ahorro     {100 * (1 - results['slots'] / results['dict']):7.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Rendimiento de lectura/escritura de entry_logs.json por serializador.
+
+Uso:
+    python backend/benchmarks/bench_serialization.py [--sizes 1000 10000 100000]
+
+Compara el formato anterior (json indentado) con el formato compacto de
+cada serializador disponible en main.SERIALIZERS.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_logs(count):
+    return [
+        {
+            "timestamp": f"2025-06-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{i % 60:02d}",
+            "driver_name": f"Chofer Gutiérrez {i % 5000}",
+            "qr_code": f"{i:012x}",
+            "status": "Entrada válida" if i % 10 else "QR inválido",
+            "notes": "QR generado el 2025-06-06T14:18:12.578928"
+        }
+        for i in range(count)
+    ]
+
+
+class IndentedStdlib:
+    # Formato usado antes: json.dump(..., indent=2)
+    name = "json indent=2"
+
+    def dumps(self, obj, pretty=False):
+        return json.dumps(obj, indent=2).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+def best_of(repeat, fn):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # main.py crea data/ y static/ en el directorio actual: usar uno temporal
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, BACKEND_DIR)
+    from main import SERIALIZERS
+
+    serializers = [IndentedStdlib()] + [cls() for cls in SERIALIZERS.values()]
+    path = os.path.join(os.getcwd(), "entry_logs.json")
+
+    print(f"{'registros':>10} {'serializador':<15} {'tamaño':>10} {'escritura':>12} {'lectura':>12}")
+    for size in args.sizes:
+        logs = make_logs(size)
+        for serializer in serializers:
+            def write():
+                with open(path, "wb") as f:
+                    f.write(serializer.dumps(logs))
+
+            def read():
+                with open(path, "rb") as f:
+                    serializer.loads(f.read())
+
+            write_time = best_of(args.repeat, write)
+            read_time = best_of(args.repeat, read)
+            file_mb = os.path.getsize(path) / (1024 * 1024)
+            print(f"{size:>10,} {serializer.name:<15} {file_mb:>8.2f}MB "
+                  f"{size / write_time:>9,.0f}/s {size / read_time:>9,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
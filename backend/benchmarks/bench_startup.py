@@ -0,0 +1,75 @@
+"""Tiempo de arranque de un worker: carga desde disco vs snapshot binario.
+
+Uso:
+    python backend/benchmarks/bench_startup.py [--drivers 20000] [--logs 500000]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cada arranque en un proceso nuevo; startup_report mide solo la carga del estado
+MEASURE = ("import sys; sys.path.insert(0, %r); import main; "
+           "print(main.startup_report['source'], main.startup_report['seconds'])" % BACKEND_DIR)
+
+
+def start_worker():
+    output = subprocess.run([sys.executable, "-c", MEASURE], capture_output=True, text=True, check=True)
+    source, seconds = output.stdout.split()[-2:]
+    return source, float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--drivers", type=int, default=20_000)
+    parser.add_argument("--logs", type=int, default=500_000)
+    args = parser.parse_args()
+
+    # main.py crea data/ y static/ en el directorio actual: usar uno temporal
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs("data")
+
+    random.seed(1)
+    start = datetime(2025, 1, 1)
+    drivers = {}
+    for i in range(args.drivers):
+        code = f"{i:012x}"
+        drivers[code] = {"name": f"Chofer {i}", "code": code,
+                         "generated_at": (start + timedelta(minutes=i)).isoformat(),
+                         "qr_image": f"static/qr_codes/qr_{code}.png", "used": False}
+    codes = list(drivers)
+    logs = []
+    for i in range(args.logs):
+        code = random.choice(codes)
+        logs.append({"timestamp": (start + timedelta(seconds=30 * i)).strftime("%Y-%m-%d %H:%M:%S"),
+                     "driver_name": drivers[code]["name"], "qr_code": code,
+                     "status": random.choice(["Entrada válida", "Salida válida"]),
+                     "notes": "", "event_id": f"evt-{i}"})
+    with open("data/drivers.json", "w") as f:
+        json.dump(drivers, f, separators=(",", ":"))
+    with open("data/entry_logs.json", "w") as f:
+        json.dump(logs, f, separators=(",", ":"), ensure_ascii=False)
+
+    cold = start_worker()
+
+    sys.path.insert(0, BACKEND_DIR)
+    import asyncio
+    import main as backend
+    asyncio.run(backend.run_snapshot())
+
+    warm = start_worker()
+
+    print(f"Estado: {args.drivers:,} choferes, {args.logs:,} registros")
+    for source, seconds in (cold, warm):
+        print(f"  {source:<10} {seconds * 1000:10.1f} ms")
+    print(f"  tamaño     {os.path.getsize(backend.SNAPSHOT_FILE) / 1e6:10.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Servidor clave-valor en memoria para pruebas locales del estado compartido.
+
+Implementa el subconjunto del protocolo de Redis (RESP) que usa
+NetworkBackend en main.py: cadenas, conjuntos y pub/sub. No persiste nada.
+
+Uso:
+    python backend/kv_server.py --port 6390
+    STATE_BACKEND_URL=kv://localhost:6390 python backend/main.py
+"""
+import argparse
+import asyncio
+
+
+class Error(str):
+    pass
+
+
+class Status(str):
+    pass
+
+
+NO_REPLY = object()
+
+
+def encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Error):
+        return b"-" + reply.encode() + b"\r\n"
+    if isinstance(reply, Status):
+        return b"+" + reply.encode() + b"\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, (list, set)):
+        return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+    data = reply if isinstance(reply, bytes) else str(reply).encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Comando en línea (p. ej. desde telnet)
+        return line.decode().split()
+    args = []
+    for _ in range(int(line[1:])):
+        header = await reader.readline()
+        length = int(header[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class KeyValueServer:
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.channels = {}
+
+    def execute(self, args, writer):
+        name = (args[0].decode() if isinstance(args[0], bytes) else args[0]).upper()
+        args = [arg.encode() if isinstance(arg, str) else arg for arg in args[1:]]
+
+        if name == "PING":
+            return Status("PONG")
+        if name == "GET":
+            return self.values.get(args[0])
+        if name == "MGET":
+            return [self.values.get(key) for key in args]
+        if name == "SET":
+            self.values[args[0]] = args[1]
+            return Status("OK")
+        if name == "SETNX":
+            return self.values.setdefault(args[0], args[1]) is args[1]
+        if name == "DEL":
+            return sum(self.values.pop(key, None) is not None or self.sets.pop(key, None) is not None
+                       for key in args)
+        if name == "SADD":
+            members = self.sets.setdefault(args[0], set())
+            before = len(members)
+            members.update(args[1:])
+            return len(members) - before
+        if name == "SREM":
+            members = self.sets.get(args[0], set())
+            before = len(members)
+            members.difference_update(args[1:])
+            return before - len(members)
+        if name == "SISMEMBER":
+            return args[1] in self.sets.get(args[0], ())
+        if name == "SMEMBERS":
+            return list(self.sets.get(args[0], ()))
+        if name == "SCARD":
+            return len(self.sets.get(args[0], ()))
+        if name == "PUBLISH":
+            subscribers = self.channels.get(args[0], set())
+            for subscriber in subscribers:
+                subscriber.write(encode([b"message", args[0], args[1]]))
+            return len(subscribers)
+        if name == "SUBSCRIBE":
+            # Una confirmación por canal, como Redis
+            for count, channel in enumerate(args, start=1):
+                self.channels.setdefault(channel, set()).add(writer)
+                writer.write(encode([b"subscribe", channel, count]))
+            return NO_REPLY
+        if name == "FLUSHALL":
+            self.values.clear()
+            self.sets.clear()
+            return Status("OK")
+        return Error(f"ERR comando desconocido '{name}'")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                try:
+                    reply = self.execute(args, writer)
+                except (IndexError, ValueError):
+                    reply = Error("ERR número de argumentos incorrecto")
+                if reply is not NO_REPLY:
+                    writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subscribers in self.channels.values():
+                subscribers.discard(writer)
+            writer.close()
+
+
+async def serve(host, port):
+    kv = KeyValueServer()
+    server = await asyncio.start_server(kv.handle, host, port)
+    print(f"🗄️ Servidor de estado en {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
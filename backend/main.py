@@ -1,18 +1,42 @@
-from fastapi import FastAPI, Form, HTTPException, Request
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from pydantic import BaseModel
+from typing import List, Optional, Literal
 import qrcode
 import json
 import csv
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import hashlib
+import hmac
 import base64
 from PIL import Image
 import io
+import bisect
+import math
+import time
+import asyncio
+import socket
+import threading
+import signal
+import mmap
+import struct
+from urllib.parse import urlparse
+from collections import OrderedDict
 import pandas as pd
 
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # opcional: serialización JSON en C
+    orjson = None
+
 app = FastAPI(title="Sistema de Registro de Camiones")
 
 # Configurar directorios
@@ -24,53 +48,1464 @@ os.makedirs("templates", exist_ok=True)
 DRIVERS_FILE = "data/drivers.json"
 LOGS_FILE = "data/entry_logs.json"
 LOGS_CSV_FILE = "data/entry_logs.csv"
+DRIVER_CHANGES_FILE = "data/driver_changes.jsonl"
+RATE_LIMITS_FILE = "data/rate_limits.json"
+APPOINTMENTS_FILE = "data/appointments.csv"
+
+# Máximo de cambios de choferes por respuesta de /api/drivers/changes y /api/sync
+DRIVER_CHANGES_PAGE_SIZE = 1000
+# Cambios recientes que la compactación deja intactos (entregables como diferencias)
+DRIVER_CHANGES_RETAIN = 10000
+
+# Revocaciones: retraso máximo para que un worker vea las de otros procesos
+# y capacidad inicial del filtro de Bloom (se amplía al reconstruirlo)
+REVOCATION_REFRESH_SECONDS = 2
+REVOCATION_FILTER_CAPACITY = 10000
+REVOCATION_FILTER_ERROR_RATE = 0.01
+
+# Endpoints /api/admin/*: exigen el encabezado X-Admin-Token con este valor;
+# sin ADMIN_TOKEN solo se aceptan desde el propio host
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") or None
+ADMIN_LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+# Hora de escaneo que informa la caseta al sincronizar su cola local: fuera
+# de este rango (reloj del dispositivo mal puesto) se usa la del servidor
+SYNC_MAX_EVENT_AGE_HOURS = 168
+SYNC_CLOCK_SKEW_SECONDS = 300
+
+# Modos de escaneo y estados de log que cuentan como paso autorizado
+SCAN_MODES = ("entrada", "salida")
+ENTRY_STATUSES = ("Entrada válida", "Llegada anticipada", "Llegada tardía")
+EXIT_STATUSES = ("Salida válida", "Salida sin entrada")
+AUTHORIZED_STATUSES = ENTRY_STATUSES + EXIT_STATUSES
+
+# Citas de andén: margen aceptado antes/después de la ventana, frecuencia
+# con la que cada worker revisa (en segundo plano) si data/appointments.csv
+# cambió y antigüedad tras la cual una ventana ya terminada se descarta
+APPOINTMENT_TOLERANCE_MINUTES = 15
+APPOINTMENTS_REFRESH_SECONDS = 5
+APPOINTMENT_RETENTION_DAYS = 7
+APPOINTMENTS_LOCK_FILE = "data/.appointments.lock"
+
+# Estado compartido entre nodos: memory:// (en proceso, por defecto) o
+# kv://host:puerto / redis://host:puerto (ver backend/kv_server.py)
+STATE_BACKEND_URL = os.environ.get("STATE_BACKEND_URL", "memory://")
+STATE_BACKEND_TIMEOUT_SECONDS = 2
+
+# Recolección de basura en segundo plano: choferes vencidos o duplicados,
+# imágenes QR huérfanas y compactación del registro de cambios
+GC_INTERVAL_SECONDS = 3600
+GC_BATCH_SIZE = 500                 # elementos procesados antes de ceder el event loop
+DRIVER_EXPIRY_DAYS = None           # sin uso en este periodo: se revoca como vencido (None desactiva)
+DRIVER_EXPIRY_REASON = "Vencido por inactividad"
+ORPHAN_MIN_AGE_SECONDS = 600        # no tocar imágenes recién creadas
+GC_LOCK_FILE = "data/.gc.lock"
+
+# Snapshot binario del estado (choferes, revocaciones, eventos y ocupación)
+# que los workers mapean en memoria al arrancar; solo se reaplica lo posterior
+SNAPSHOT_FILE = "data/state.snapshot"
+SNAPSHOT_INTERVAL_SECONDS = 300
+SNAPSHOT_LOCK_FILE = "data/.snapshot.lock"
+
+# Apagado ordenado: tiempo para que el balanceador vea /readyz en 503 antes de
+# salir y espera máxima para los escaneos en curso
+DRAIN_GRACE_SECONDS = 5
+DRAIN_TIMEOUT_SECONDS = 30
+
+# Consultas de /api/analytics: agrupaciones permitidas y máximo de grupos por respuesta
+ANALYTICS_GROUPS = ("driver", "hour", "day", "status")
+ANALYTICS_GROUP_LIMIT = 100
+
+# Control de admisión de la API de validación. Se pueden sobrescribir en
+# data/rate_limits.json (por caseta en "gates"); el archivo se relee al cambiar
+RATE_LIMITED_PATHS = ("/api/validate-qr", "/api/sync")
+RATE_LIMITS_REFRESH_SECONDS = 5
+RATE_BUCKETS_MAX = 10000    # clientes recordados; se descartan los de uso menos reciente
+SYNC_MAX_EVENTS = 200       # eventos por solicitud a /api/sync (la página envía lotes de 200)
+DEFAULT_RATE_LIMITS = {
+    "rate": 5.0,            # escaneos por segundo por caseta/cliente
+    "burst": 20,            # ráfaga máxima por caseta/cliente
+    "max_concurrent": 32,   # solicitudes simultáneas en todo el worker
+    "gates": {}             # {"caseta-norte": {"rate": 10, "burst": 40}}
+}
+
+# Serializadores JSON intercambiables. En disco se escribe en formato
+# compacto; la salida legible (indentada) queda para las exportaciones
+class StdlibSerializer:
+    name = "json"
+    
+    def dumps(self, obj, pretty=False):
+        if pretty:
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonSerializer:
+    name = "orjson"
+    
+    def dumps(self, obj, pretty=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    
+    def loads(self, data):
+        return orjson.loads(data)
+
+SERIALIZERS = {"json": StdlibSerializer}
+if orjson is not None:
+    SERIALIZERS["orjson"] = OrjsonSerializer
+
+def get_serializer(name=None):
+    # JSON_SERIALIZER permite forzar uno; por defecto el más rápido disponible
+    name = name or os.environ.get("JSON_SERIALIZER") or ("orjson" if orjson is not None else "json")
+    if name not in SERIALIZERS:
+        raise ValueError(f"Serializador no disponible: {name}")
+    return SERIALIZERS[name]()
+
+serializer = get_serializer()
+
+def read_json(path):
+    with open(path, 'rb') as f:
+        return serializer.loads(f.read())
+
+def write_json(path, obj, pretty=False):
+    # Escritura atómica: un proceso detenido a mitad no deja el archivo truncado
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(serializer.dumps(obj, pretty))
+    os.replace(tmp_path, path)
 
 # Inicializar archivos si no existen
 def init_data_files():
     if not os.path.exists(DRIVERS_FILE):
-        with open(DRIVERS_FILE, 'w') as f:
-            json.dump({}, f)
+        write_json(DRIVERS_FILE, {})
     
     if not os.path.exists(LOGS_FILE):
-        with open(LOGS_FILE, 'w') as f:
-            json.dump([], f)
+        write_json(LOGS_FILE, [])
     
     if not os.path.exists(LOGS_CSV_FILE):
         with open(LOGS_CSV_FILE, 'w', newline='') as f:
             writer = csv.writer(f)
             writer.writerow(['timestamp', 'driver_name', 'qr_code', 'status', 'notes'])
+    
+    if not os.path.exists(DRIVER_CHANGES_FILE):
+        # Registro inicial de cambios con los choferes ya existentes
+        drivers = read_json(DRIVERS_FILE)
+        existing = sorted(drivers.items(), key=lambda item: item[1].get('generated_at', ''))
+        with open(DRIVER_CHANGES_FILE, 'wb') as f:
+            for version, (code, driver) in enumerate(existing, start=1):
+                change = {
+                    "version": version,
+                    "op": "upsert",
+                    "code": code,
+                    "timestamp": driver.get('generated_at', ''),
+                    "driver": driver
+                }
+                f.write(serializer.dumps(change) + b"\n")
 
 init_data_files()
 
+# Modelos compactos: __slots__ evita un diccionario por instancia, lo que
+# reduce memoria al mantener miles de choferes o registros cargados
+class Driver:
+    __slots__ = ("name", "code", "generated_at", "qr_image", "used")
+    
+    def __init__(self, name, code, generated_at, qr_image, used=False):
+        self.name = name
+        self.code = code
+        self.generated_at = generated_at
+        self.qr_image = qr_image
+        self.used = used
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["name"], data["code"], data["generated_at"],
+                   data["qr_image"], data.get("used", False))
+    
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "code": self.code,
+            "generated_at": self.generated_at,
+            "qr_image": self.qr_image,
+            "used": self.used
+        }
+    
+    def __repr__(self):
+        return f"Driver(code={self.code!r}, name={self.name!r})"
+
+class LogEntry:
+    __slots__ = ("timestamp", "driver_name", "qr_code", "status", "notes", "event_id", "gate")
+    
+    def __init__(self, timestamp, driver_name, qr_code, status, notes="", event_id=None, gate=None):
+        self.timestamp = timestamp
+        self.driver_name = driver_name
+        self.qr_code = qr_code
+        self.status = status
+        self.notes = notes
+        self.event_id = event_id
+        self.gate = gate
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["timestamp"], data["driver_name"], data["qr_code"], data["status"],
+                   data.get("notes", ""), data.get("event_id"), data.get("gate"))
+    
+    def to_dict(self):
+        data = {
+            "timestamp": self.timestamp,
+            "driver_name": self.driver_name,
+            "qr_code": self.qr_code,
+            "status": self.status,
+            "notes": self.notes
+        }
+        # Los campos opcionales solo se guardan si tienen valor
+        if self.event_id is not None:
+            data["event_id"] = self.event_id
+        if self.gate is not None:
+            data["gate"] = self.gate
+        return data
+    
+    def to_row(self):
+        return [self.timestamp, self.driver_name, self.qr_code, self.status, self.notes]
+    
+    def __repr__(self):
+        return f"LogEntry(timestamp={self.timestamp!r}, qr_code={self.qr_code!r}, status={self.status!r})"
+
 def load_drivers():
-    with open(DRIVERS_FILE, 'r') as f:
-        return json.load(f)
+    return {code: Driver.from_dict(data) for code, data in read_json(DRIVERS_FILE).items()}
 
 def save_drivers(drivers):
-    with open(DRIVERS_FILE, 'w') as f:
-        json.dump(drivers, f, indent=2)
+    write_json(DRIVERS_FILE, {code: driver.to_dict() for code, driver in drivers.items()})
 
 def load_logs():
-    with open(LOGS_FILE, 'r') as f:
-        return json.load(f)
+    return [LogEntry.from_dict(data) for data in read_json(LOGS_FILE)]
 
 def save_log_entry(log_entry):
-    # Guardar en JSON
-    logs = load_logs()
-    logs.append(log_entry)
-    with open(LOGS_FILE, 'w') as f:
-        json.dump(logs, f, indent=2)
+    save_log_entries([log_entry])
+
+def save_log_entries(log_entries):
+    # Guardar en JSON (una sola reescritura por lote, sin reconstruir modelos)
+    logs = read_json(LOGS_FILE)
+    logs.extend(log_entry.to_dict() for log_entry in log_entries)
+    write_json(LOGS_FILE, logs)
     
     # Guardar en CSV
     with open(LOGS_CSV_FILE, 'a', newline='') as f:
         writer = csv.writer(f)
-        writer.writerow([
-            log_entry['timestamp'],
-            log_entry['driver_name'],
-            log_entry['qr_code'],
-            log_entry['status'],
-            log_entry.get('notes', '')
-        ])
+        writer.writerows(log_entry.to_row() for log_entry in log_entries)
+
+# Backend de estado: choferes, eventos ya procesados y revocaciones.
+# Interfaz mínima de claves, conjuntos y pub/sub; los suscriptores reciben
+# None cuando pudieron perderse mensajes y deben invalidar todo
+class StateBackend:
+    shared = False  # True si el estado vive fuera del proceso
+    
+    def get(self, key):
+        raise NotImplementedError
+    
+    def mget(self, *keys):
+        raise NotImplementedError
+    
+    def set(self, key, value):
+        raise NotImplementedError
+    
+    def setnx(self, key, value):
+        raise NotImplementedError
+    
+    def delete(self, key):
+        raise NotImplementedError
+    
+    def sadd(self, key, *members):
+        raise NotImplementedError
+    
+    def srem(self, key, *members):
+        raise NotImplementedError
+    
+    def sismember(self, key, member):
+        raise NotImplementedError
+    
+    def smembers(self, key):
+        raise NotImplementedError
+    
+    def scard(self, key):
+        raise NotImplementedError
+    
+    def publish(self, channel, message):
+        raise NotImplementedError
+    
+    def subscribe(self, channel, callback):
+        raise NotImplementedError
+
+class InProcessBackend(StateBackend):
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.callbacks = {}
+    
+    def get(self, key):
+        return self.values.get(key)
+    
+    def mget(self, *keys):
+        return [self.values.get(key) for key in keys]
+    
+    def set(self, key, value):
+        self.values[key] = value
+    
+    def setnx(self, key, value):
+        return self.values.setdefault(key, value) is value
+    
+    def delete(self, key):
+        return self.values.pop(key, None) is not None
+    
+    def sadd(self, key, *members):
+        members_set = self.sets.setdefault(key, set())
+        before = len(members_set)
+        members_set.update(members)
+        return len(members_set) - before
+    
+    def srem(self, key, *members):
+        members_set = self.sets.get(key, set())
+        before = len(members_set)
+        members_set.difference_update(members)
+        return before - len(members_set)
+    
+    def sismember(self, key, member):
+        return member in self.sets.get(key, ())
+    
+    def smembers(self, key):
+        return set(self.sets.get(key, ()))
+    
+    def scard(self, key):
+        return len(self.sets.get(key, ()))
+    
+    def publish(self, channel, message):
+        callbacks = self.callbacks.get(channel, [])
+        for callback in callbacks:
+            callback(message)
+        return len(callbacks)
+    
+    def subscribe(self, channel, callback):
+        self.callbacks.setdefault(channel, []).append(callback)
+
+class NetworkBackend(StateBackend):
+    # Cliente RESP (protocolo de Redis) con una conexión para comandos y
+    # otra, en un hilo aparte, para las suscripciones
+    shared = True
+    
+    def __init__(self, host, port, timeout=STATE_BACKEND_TIMEOUT_SECONDS):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.conn = None
+        self.callbacks = {}
+        self.listener = None
+        self.listener_sock = None
+        self.subscribe_lock = threading.Lock()  # canales vs. (re)conexión del listener
+    
+    @staticmethod
+    def encode(args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+    
+    @classmethod
+    def read_reply(cls, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Conexión cerrada por el servidor de estado")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RuntimeError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            return None if length < 0 else reader.read(length + 2)[:-2].decode()
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [cls.read_reply(reader) for _ in range(length)]
+        raise ConnectionError(f"Respuesta inesperada del servidor de estado: {line!r}")
+    
+    def command(self, *args):
+        # Un reintento con conexión nueva si la anterior se cayó
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.conn is None:
+                        sock = socket.create_connection(self.address, timeout=self.timeout)
+                        self.conn = (sock, sock.makefile('rb'))
+                    sock, reader = self.conn
+                    sock.sendall(self.encode(args))
+                    return self.read_reply(reader)
+                except OSError:
+                    if self.conn:
+                        self.conn[0].close()
+                    self.conn = None
+                    if attempt:
+                        raise
+    
+    def get(self, key):
+        return self.command("GET", key)
+    
+    def mget(self, *keys):
+        return self.command("MGET", *keys) if keys else []
+    
+    def set(self, key, value):
+        self.command("SET", key, value)
+    
+    def setnx(self, key, value):
+        return self.command("SETNX", key, value) == 1
+    
+    def delete(self, key):
+        return self.command("DEL", key) == 1
+    
+    def sadd(self, key, *members):
+        return self.command("SADD", key, *members) if members else 0
+    
+    def srem(self, key, *members):
+        return self.command("SREM", key, *members) if members else 0
+    
+    def sismember(self, key, member):
+        return self.command("SISMEMBER", key, member) == 1
+    
+    def smembers(self, key):
+        return set(self.command("SMEMBERS", key))
+    
+    def scard(self, key):
+        return self.command("SCARD", key)
+    
+    def publish(self, channel, message):
+        return self.command("PUBLISH", channel, message)
+    
+    def subscribe(self, channel, callback):
+        # Bajo el bloqueo, o el canal entra en el SUBSCRIBE de la conexión
+        # siguiente, o se envía por la ya establecida
+        with self.subscribe_lock:
+            self.callbacks.setdefault(channel, []).append(callback)
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, daemon=True)
+                self.listener.start()
+            elif self.listener_sock is not None:
+                self.listener_sock.sendall(self.encode(["SUBSCRIBE", channel]))
+    
+    def notify(self, channel, message):
+        for callback in list(self.callbacks.get(channel, [])):
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"⚠️ Error procesando mensaje de {channel}: {e}")
+    
+    def listen(self):
+        # Cualquier error (conexión, respuesta -ERR o malformada) reconecta:
+        # si el hilo muriera, el nodo dejaría de invalidar sus cachés
+        delay = 0.5
+        while True:
+            sock = None
+            try:
+                sock = socket.create_connection(self.address)
+                reader = sock.makefile('rb')
+                with self.subscribe_lock:
+                    sock.sendall(self.encode(["SUBSCRIBE", *self.callbacks]))
+                    self.listener_sock = sock
+                # Tras (re)conectar pudieron perderse mensajes: invalidar todo
+                for channel in list(self.callbacks):
+                    self.notify(channel, None)
+                delay = 0.5
+                while True:
+                    reply = self.read_reply(reader)
+                    if reply and reply[0] == "message":
+                        self.notify(reply[1], reply[2])
+            except Exception as e:
+                print(f"⚠️ Suscripción al servidor de estado interrumpida: {e}")
+                with self.subscribe_lock:
+                    self.listener_sock = None
+                if sock is not None:
+                    sock.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+def create_state_backend(url):
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return InProcessBackend()
+    if parsed.scheme in ("kv", "redis"):
+        return NetworkBackend(parsed.hostname or "localhost", parsed.port or 6379)
+    raise ValueError(f"Backend de estado no soportado: {url}")
+
+state = create_state_backend(STATE_BACKEND_URL)
+
+# Caché local de choferes, invalidada por pub/sub cuando cualquier nodo los modifica
+driver_cache = {}
+
+def on_driver_message(code):
+    if code is None:
+        driver_cache.clear()
+    else:
+        driver_cache.pop(code, None)
+
+state.subscribe("drivers", on_driver_message)
+
+def put_driver_state(driver):
+    state.set(f"driver:{driver.code}", serializer.dumps(driver.to_dict()).decode("utf-8"))
+    state.sadd("drivers", driver.code)
+    state.publish("drivers", driver.code)
+
+# Registro de cambios de choferes: cada alta o baja recibe una versión
+# monotónica para que cachés y casetas solo descarguen las diferencias.
+# Con estado en proceso vive en DRIVER_CHANGES_FILE; con estado compartido,
+# en el backend (ver record_shared_driver_change), para que todos los nodos
+# entreguen las mismas versiones
+driver_changes = []
+driver_change_versions = []
+driver_changes_offset = 0
+driver_changes_inode = None
+driver_changes_floor = 0        # versión hasta la que el registro está compactado
+driver_changes_generation = 0   # cambia cada vez que el registro se vuelve a leer desde cero
+driver_changes_base = 0         # versión anterior a la primera línea leída (arranque desde snapshot)
+
+def refresh_driver_changes():
+    # Leer solo las líneas añadidas desde la última lectura
+    global driver_changes_offset, driver_changes_inode, driver_changes_floor
+    global driver_changes_generation, driver_changes_base
+    with open(DRIVER_CHANGES_FILE, 'rb') as f:
+        inode = os.fstat(f.fileno()).st_ino
+        if inode != driver_changes_inode:
+            # El archivo fue reemplazado (compactación): releer completo
+            driver_changes.clear()
+            driver_change_versions.clear()
+            driver_changes_offset = 0
+            driver_changes_inode = inode
+            driver_changes_floor = 0
+            driver_changes_base = 0
+            driver_changes_generation += 1
+        
+        f.seek(driver_changes_offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # línea a medio escribir por otro proceso
+            change = serializer.loads(line)
+            if change["op"] == "compact":
+                driver_changes_floor = change["version"]
+            driver_changes.append(change)
+            driver_change_versions.append(change["version"])
+            driver_changes_offset += len(line)
+
+def current_driver_version():
+    refresh_driver_changes()
+    return driver_change_versions[-1] if driver_change_versions else driver_changes_base
+
+def open_driver_changes_locked():
+    # Abrir el registro con bloqueo exclusivo, reintentando si otro proceso
+    # lo reemplazó mientras se esperaba el bloqueo
+    while True:
+        f = open(DRIVER_CHANGES_FILE, 'ab')
+        if not fcntl:
+            return f
+        fcntl.flock(f, fcntl.LOCK_EX)
+        if os.fstat(f.fileno()).st_ino == os.stat(DRIVER_CHANGES_FILE).st_ino:
+            return f
+        f.close()
+
+def record_driver_change(op, code, driver=None, reason=None):
+    change = {"op": op, "code": code, "timestamp": datetime.now().isoformat()}
+    if driver is not None:
+        change["driver"] = driver
+    if reason:
+        change["reason"] = reason
+    if state.shared:
+        return record_shared_driver_change(change)
+    
+    with open_driver_changes_locked() as f:
+        change = {"version": current_driver_version() + 1, **change}
+        f.write(serializer.dumps(change) + b"\n")
+        f.flush()
+    
+    refresh_driver_changes()
+    return change["version"]
+
+# Registro compartido: cada cambio en driver_change:<versión>. La versión se
+# reclama con SETNX, así que es única entre nodos y no quedan huecos aunque
+# un nodo caiga a mitad de la escritura. drivers:version es solo una pista
+# del último cambio y drivers:floor la versión hasta la que se compactó
+def shared_driver_version():
+    version = max(int(state.get("drivers:version") or 0), int(state.get("drivers:floor") or 0))
+    while state.get(f"driver_change:{version + 1}") is not None:
+        version += 1
+    return version
+
+def record_shared_driver_change(change):
+    version = shared_driver_version()
+    while True:
+        version += 1
+        if state.setnx(f"driver_change:{version}", serializer.dumps({"version": version, **change}).decode("utf-8")):
+            break
+    state.set("drivers:version", version)
+    return version
+
+def compact_shared_driver_changes():
+    # Sin estado por código que conservar: lo anterior a DRIVER_CHANGES_RETAIN
+    # se descarta y las casetas con cursores más viejos reciben la tabla completa
+    version = shared_driver_version()
+    floor = int(state.get("drivers:floor") or 0)
+    cutoff = version - DRIVER_CHANGES_RETAIN
+    if cutoff <= floor:
+        return 0
+    state.set("drivers:floor", cutoff)
+    for old in range(floor + 1, cutoff + 1):
+        state.delete(f"driver_change:{old}")
+    return cutoff - floor
+
+def compact_driver_changes():
+    # Conserva las últimas DRIVER_CHANGES_RETAIN entradas tal cual; de las
+    # anteriores solo queda el último cambio de cada código aún registrado
+    global driver_changes_inode
+    if state.shared:
+        return compact_shared_driver_changes()
+    with open_driver_changes_locked() as f:
+        if driver_changes_base:
+            # Tras un arranque desde snapshot solo está en memoria la cola del
+            # registro; compactar exige verlo completo
+            driver_changes_inode = None
+        refresh_driver_changes()
+        cutoff = len(driver_changes) - DRIVER_CHANGES_RETAIN
+        if cutoff <= 0:
+            return 0
+        
+        latest = {}
+        for change in driver_changes[:cutoff]:
+            if change["op"] != "compact":
+                latest[change["code"]] = change
+        kept = sorted(latest.values(), key=lambda c: c["version"])
+        removed = cutoff - len(kept) - 1
+        if removed <= 0:
+            return 0
+        
+        marker = {
+            "version": driver_change_versions[cutoff - 1],
+            "op": "compact",
+            "code": "",
+            "timestamp": datetime.now().isoformat()
+        }
+        
+        tmp_path = DRIVER_CHANGES_FILE + ".tmp"
+        with open(tmp_path, 'wb') as out:
+            for change in kept + [marker] + driver_changes[cutoff:]:
+                out.write(serializer.dumps(change) + b"\n")
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, DRIVER_CHANGES_FILE)
+    
+    refresh_driver_changes()
+    return removed
+
+def full_driver_table(version):
+    refresh_state(force=True)
+    revoked = state.smembers("revoked")
+    if state.shared:
+        # drivers.json es local de cada nodo: la tabla sale del backend
+        drivers = {}
+        codes = sorted(state.smembers("drivers") - revoked)
+        for start in range(0, len(codes), DRIVER_CHANGES_PAGE_SIZE):
+            keys = [f"driver:{code}" for code in codes[start:start + DRIVER_CHANGES_PAGE_SIZE]]
+            for data in state.mget(*keys):
+                if data is not None:
+                    driver = serializer.loads(data)
+                    drivers[driver["code"]] = driver
+    else:
+        drivers = {code: driver.to_dict() for code, driver in load_drivers().items() if code not in revoked}
+    return {"full": True, "version": version, "drivers": drivers, "changes": [], "has_more": False}
+
+def shared_driver_changes_since(since, limit):
+    version = shared_driver_version()
+    if since is None or since < int(state.get("drivers:floor") or 0) or since > version:
+        return full_driver_table(version)
+    
+    end = min(version, since + limit)
+    values = state.mget(*[f"driver_change:{v}" for v in range(since + 1, end + 1)])
+    if None in values:
+        return full_driver_table(version)  # compactado mientras se leía
+    has_more = end < version
+    return {
+        "full": False,
+        "version": end if has_more else version,
+        "drivers": {},
+        "changes": [serializer.loads(value) for value in values],
+        "has_more": has_more
+    }
+
+def read_older_driver_changes(since, limit):
+    # Tras arrancar desde snapshot solo la cola del registro está en memoria;
+    # lo anterior se lee del archivo cuando una caseta con un cursor viejo lo
+    # pide, en vez de mandarle la tabla completa. None si el archivo cambió
+    changes = []
+    with open(DRIVER_CHANGES_FILE, 'rb') as f:
+        if os.fstat(f.fileno()).st_ino != driver_changes_inode:
+            return None
+        for line in f:
+            change = serializer.loads(line)
+            if change["version"] > driver_changes_base or len(changes) == limit:
+                break
+            if change["version"] > since:
+                changes.append(change)
+    return changes
+
+def driver_changes_since(since, limit=DRIVER_CHANGES_PAGE_SIZE):
+    # Sin cursor (o con uno anterior al registro conservado) se envía la tabla completa
+    if state.shared:
+        return shared_driver_changes_since(since, limit)
+    version = current_driver_version()
+    oldest = driver_change_versions[0] if driver_change_versions else version + 1
+    
+    if since is None or since < driver_changes_floor:
+        return full_driver_table(version)
+    if since < oldest - 1:
+        older = read_older_driver_changes(since, limit) if driver_changes_base else None
+        if older is None:
+            return full_driver_table(version)
+        changes = older + driver_changes[:limit - len(older)]
+        has_more = len(older) == limit or limit - len(older) < len(driver_changes)
+    else:
+        start = bisect.bisect_right(driver_change_versions, since)
+        changes = driver_changes[start:start + limit]
+        has_more = start + limit < len(driver_changes)
+    
+    return {
+        "full": False,
+        "version": changes[-1]["version"] if has_more else version,
+        "drivers": {},
+        "changes": changes,
+        "has_more": has_more
+    }
+
+class BloomFilter:
+    # Conjunto probabilístico: sin falsos negativos, con falsos positivos acotados
+    def __init__(self, capacity, error_rate=REVOCATION_FILTER_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, key):
+        # Doble hashing: k posiciones a partir de dos hashes de 64 bits
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+    
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+    
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+# Lista de revocación en el backend de estado. El filtro de Bloom local
+# descarta casi todos los códigos válidos sin consultar el conjunto completo
+revocation_filter = BloomFilter(REVOCATION_FILTER_CAPACITY)
+revocation_stale = 0
+revocation_filter_dirty = False
+changes_applied = 0
+changes_generation = 0
+state_checked_at = 0.0
+
+# El hilo de pub/sub agrega al filtro mientras el principal puede estar
+# reconstruyéndolo: sin el bloqueo, un "+código" llegado entre la lectura del
+# conjunto y el reemplazo quedaría en el filtro descartado
+revocation_lock = threading.RLock()
+
+def rebuild_revocation_filter():
+    global revocation_filter, revocation_stale, revocation_filter_dirty
+    with revocation_lock:
+        revoked = state.smembers("revoked")
+        new_filter = BloomFilter(max(REVOCATION_FILTER_CAPACITY, 2 * len(revoked)))
+        for code in revoked:
+            new_filter.add(code)
+        revocation_filter = new_filter
+        revocation_stale = 0
+        revocation_filter_dirty = False
+
+def on_revocation_message(message):
+    # "+código" al revocar, "-código" al restablecer; None tras reconectar
+    global revocation_stale, revocation_filter_dirty
+    with revocation_lock:
+        if message is None:
+            revocation_filter_dirty = True
+        elif message.startswith("+"):
+            revocation_filter.add(message[1:])
+        else:
+            # Un filtro de Bloom no permite borrar: se marca como obsoleto
+            revocation_stale += 1
+
+state.subscribe("revocations", on_revocation_message)
+
+def set_revoked(code, reason=""):
+    if state.sadd("revoked", code):
+        state.set(f"revoked:{code}", reason)
+        state.publish("revocations", f"+{code}")
+
+def clear_revoked(code):
+    if state.srem("revoked", code):
+        state.delete(f"revoked:{code}")
+        state.publish("revocations", f"-{code}")
+
+def apply_driver_changes():
+    # Con estado en proceso, los demás workers del host solo se enteran de
+    # los cambios a través del registro; con estado compartido ya están en él
+    global changes_applied, changes_generation
+    if changes_generation != driver_changes_generation:
+        changes_applied = 0
+        changes_generation = driver_changes_generation
+    
+    if not state.shared:
+        for change in driver_changes[changes_applied:]:
+            if change["op"] in ("upsert", "reinstate"):
+                put_driver_state(Driver.from_dict(change["driver"]))
+            if change["op"] == "revoke":
+                set_revoked(change["code"], change.get("reason", ""))
+            elif change["op"] == "reinstate":
+                clear_revoked(change["code"])
+    changes_applied = len(driver_changes)
+
+def refresh_state(force=False):
+    now = time.monotonic()
+    global state_checked_at
+    if force or now - state_checked_at >= REVOCATION_REFRESH_SECONDS:
+        state_checked_at = now
+        refresh_driver_changes()
+        apply_driver_changes()
+    
+    if (revocation_filter_dirty or revocation_filter.count > revocation_filter.capacity
+            or revocation_stale > revocation_filter.capacity // 2):
+        rebuild_revocation_filter()
+
+def is_revoked(code):
+    refresh_state()
+    return code in revocation_filter and state.sismember("revoked", code)
+
+def revocation_reason(code):
+    return state.get(f"revoked:{code}") or ""
+
+def lookup_driver(code):
+    driver = driver_cache.get(code)
+    if driver is not None:
+        return driver
+    
+    data = state.get(f"driver:{code}")
+    if data is None and not state.shared:
+        # Otro worker de este host pudo crearlo hace instantes
+        refresh_state(force=True)
+        data = state.get(f"driver:{code}")
+    if data is None and state_snapshot is not None:
+        data = state_snapshot.get("drivers", code)
+    if data is None:
+        return None
+    
+    driver = driver_cache[code] = Driver.from_dict(serializer.loads(data))
+    return driver
+
+def register_event(event_id):
+    # False si el evento ya se procesó (en el snapshot o en el backend)
+    if state_snapshot is not None and state_snapshot.get("events", event_id) is not None:
+        return False
+    return bool(state.sadd("events", event_id))
+
+def seed_state():
+    # Completar el backend con lo que hay en disco sin pisar lo que ya tenga
+    drivers = load_drivers()
+    for code, driver in drivers.items():
+        state.setnx(f"driver:{code}", serializer.dumps(driver.to_dict()).decode("utf-8"))
+    state.sadd("drivers", *drivers)
+    state.sadd("events", *[log.event_id for log in load_logs() if log.event_id])
+    refresh_state(force=True)
+    rebuild_revocation_filter()
+
+# Ocupación del patio: conjunto "yard" con los códigos dentro y, por código,
+# la hora de entrada; las estadísticas de permanencia se acumulan al salir.
+# Los escaneos de la cola local llegan tarde y fuera de orden, así que cada
+# movimiento se compara con la hora de la última salida del código en vez de
+# aplicarse en orden de llegada
+def parse_log_timestamp(timestamp):
+    return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+
+def format_dwell(seconds):
+    hours, minutes = divmod(int(seconds) // 60, 60)
+    return f"{hours} h {minutes} min" if hours else f"{minutes} min"
+
+def load_dwell_stats(code, store):
+    return serializer.loads(store.get(f"dwell:{code}") or '{"visits": 0, "total_seconds": 0}')
+
+def record_visit(code, entered_at, exited_at, stats, store):
+    dwell = max(0, (parse_log_timestamp(exited_at) - parse_log_timestamp(entered_at)).total_seconds())
+    stats["visits"] += 1
+    stats["total_seconds"] += dwell
+    stats["last_seconds"] = dwell
+    store.set(f"dwell:{code}", serializer.dumps(stats).decode("utf-8"))
+    return dwell
+
+def yard_enter(code, driver_name, timestamp, store=None):
+    # Devuelve (hora de entrada previa si el camión ya figuraba dentro,
+    # hora de la salida posterior que ya cerró esta entrada si llegó tarde)
+    store = state if store is None else store
+    stats = load_dwell_stats(code, store)
+    last_exit = stats.get("last_exit_at")
+    if last_exit and timestamp < last_exit:
+        # Entrada anterior a una salida ya registrada: no deja el camión dentro.
+        # Si esa salida quedó sin entrada, se completa la visita
+        unmatched = stats.pop("unmatched_exit_at", None)
+        if unmatched and timestamp <= unmatched:
+            record_visit(code, timestamp, unmatched, stats, store)
+            return None, unmatched
+        return None, last_exit
+    
+    previous = store.get(f"yard:{code}")
+    previous = serializer.loads(previous)["entered_at"] if previous else None
+    if previous and previous > timestamp:
+        return previous, None  # se conserva la entrada más reciente
+    store.sadd("yard", code)
+    store.set(f"yard:{code}", serializer.dumps({"driver_name": driver_name, "entered_at": timestamp}).decode("utf-8"))
+    return previous, None
+
+def yard_exit(code, timestamp, store=None):
+    # Devuelve la permanencia en segundos, o None si no había entrada registrada
+    # antes de esta salida
+    store = state if store is None else store
+    entry = store.get(f"yard:{code}")
+    entry = serializer.loads(entry) if entry else None
+    if entry is not None and entry["entered_at"] > timestamp:
+        return None  # salida de una visita anterior; la entrada actual sigue abierta
+    
+    if entry is not None and not store.srem("yard", code):
+        return None  # otro worker registró la salida
+    
+    stats = load_dwell_stats(code, store)
+    stats["last_exit_at"] = max(stats.get("last_exit_at") or timestamp, timestamp)
+    if entry is None:
+        # Puede llegar después la entrada encolada offline que la completa
+        stats["unmatched_exit_at"] = max(stats.get("unmatched_exit_at") or timestamp, timestamp)
+        store.set(f"dwell:{code}", serializer.dumps(stats).decode("utf-8"))
+        return None
+    store.delete(f"yard:{code}")
+    return record_visit(code, entry["entered_at"], timestamp, stats, store)
+
+def replay_occupancy(logs, store=None):
+    # Aplicar entradas/salidas en orden de escaneo, no de llegada al servidor
+    for log in sorted(logs, key=lambda log: log.timestamp):
+        if log.status in ENTRY_STATUSES:
+            yard_enter(log.qr_code, log.driver_name, log.timestamp, store)
+        elif log.status in EXIT_STATUSES:
+            yard_exit(log.qr_code, log.timestamp, store)
+
+def rebuild_occupancy():
+    replay_occupancy(load_logs())
+
+# Snapshot binario del estado, mapeado en memoria y compartido (solo lectura)
+# por los workers del host. Formato little-endian:
+#   cabecera  magic, versión del registro de cambios, piso de compactación,
+#             offset e inodo del registro, offset del "]" final de
+#             entry_logs.json y los bytes que lo preceden, fecha de creación
+#             y posición de cada tabla
+#   tabla     número de entradas y sus posiciones, ordenadas por clave; cada
+#             entrada es longitud de clave (u16), longitud de valor (u32),
+#             clave y valor
+# Las consultas son búsquedas binarias sobre el mapa, sin deserializar la tabla
+SNAPSHOT_MAGIC = b"NNSNAP01"
+SNAPSHOT_TABLES = ("drivers", "revoked", "events", "yard", "dwell")
+SNAPSHOT_HEADER = struct.Struct("<8sQQQQQ16sd" + "Q" * len(SNAPSHOT_TABLES))
+SNAPSHOT_ENTRY = struct.Struct("<HI")
+SNAPSHOT_POSITION = struct.Struct("<Q")
+
+class StateSnapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fields = SNAPSHOT_HEADER.unpack_from(self.map, 0)
+            if fields[0] != SNAPSHOT_MAGIC:
+                raise ValueError("formato de snapshot desconocido")
+            (_, self.version, self.floor, self.changes_offset, self.changes_inode,
+             self.logs_offset, logs_tail, self.created_at) = fields[:8]
+            self.logs_tail = logs_tail.rstrip(b"\0")
+            self.tables = {}
+            for name, position in zip(SNAPSHOT_TABLES, fields[8:]):
+                count, = SNAPSHOT_POSITION.unpack_from(self.map, position)
+                self.tables[name] = (count, position + SNAPSHOT_POSITION.size)
+        except (ValueError, struct.error):
+            self.map.close()
+            raise
+    
+    def _entry(self, index, i):
+        position, = SNAPSHOT_POSITION.unpack_from(self.map, index + i * SNAPSHOT_POSITION.size)
+        key_length, value_length = SNAPSHOT_ENTRY.unpack_from(self.map, position)
+        start = position + SNAPSHOT_ENTRY.size
+        return self.map[start:start + key_length], start + key_length, value_length
+    
+    def get(self, table, key):
+        count, index = self.tables[table]
+        key = key.encode("utf-8")
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(index, middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count:
+            found, start, length = self._entry(index, low)
+            if found == key:
+                return self.map[start:start + length]
+        return None
+    
+    def items(self, table):
+        count, index = self.tables[table]
+        for i in range(count):
+            key, start, length = self._entry(index, i)
+            yield key.decode("utf-8"), self.map[start:start + length]
+    
+    def count(self, table):
+        return self.tables[table][0]
+    
+    def close(self):
+        self.map.close()
+
+def write_snapshot_file(path, header, tables):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(b"\0" * SNAPSHOT_HEADER.size)
+        positions = []
+        for name in SNAPSHOT_TABLES:
+            entries = sorted((key.encode("utf-8"), value) for key, value in tables[name].items())
+            offsets = []
+            for key, value in entries:
+                offsets.append(out.tell())
+                out.write(SNAPSHOT_ENTRY.pack(len(key), len(value)) + key + value)
+            positions.append(out.tell())
+            out.write(SNAPSHOT_POSITION.pack(len(offsets)))
+            out.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        out.seek(0)
+        out.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, *header, *positions))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+
+def capture_snapshot_state():
+    # Lo que depende del estado del worker se toma en el event loop; el
+    # resto (lectura de logs y escritura) puede ir a un hilo
+    refresh_state(force=True)
+    return {
+        "version": current_driver_version(),
+        "floor": driver_changes_floor,
+        "changes_offset": driver_changes_offset,
+        "changes_inode": driver_changes_inode,
+        "revoked": {code: revocation_reason(code).encode("utf-8") for code in state.smembers("revoked")}
+    }
+
+def write_snapshot(captured):
+    # Los choferes se leen después de fijar la versión: lo que ya refleje
+    # drivers.json de cambios posteriores se vuelve a aplicar sin efecto
+    with open(LOGS_FILE, 'rb') as f:
+        data = f.read()
+    if not data.endswith(b"]"):
+        raise ValueError(f"{LOGS_FILE} incompleto")
+    logs = [LogEntry.from_dict(entry) for entry in serializer.loads(data)]
+    drivers = read_json(DRIVERS_FILE)
+    
+    occupancy = InProcessBackend()
+    replay_occupancy(logs, occupancy)
+    
+    logs_offset = len(data) - 1
+    header = (captured["version"], captured["floor"], captured["changes_offset"], captured["changes_inode"],
+              logs_offset, data[max(0, logs_offset - 16):logs_offset], time.time())
+    write_snapshot_file(SNAPSHOT_FILE, header, {
+        "drivers": {code: serializer.dumps(driver) for code, driver in drivers.items()},
+        "revoked": captured["revoked"],
+        "events": {log.event_id: b"" for log in logs if log.event_id},
+        "yard": {code: occupancy.get(f"yard:{code}").encode("utf-8") for code in occupancy.smembers("yard")},
+        "dwell": {key[len("dwell:"):]: value.encode("utf-8")
+                  for key, value in occupancy.values.items() if key.startswith("dwell:")}
+    })
+    return len(drivers), len(logs)
+
+def snapshot_is_current(captured):
+    # Compara solo la cabecera del snapshot en disco con el estado actual
+    try:
+        with open(SNAPSHOT_FILE, 'rb') as f:
+            fields = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    except (OSError, struct.error):
+        return False
+    return (fields[0] == SNAPSHOT_MAGIC and fields[1] == captured["version"]
+            and fields[4] == captured["changes_inode"]
+            and fields[5] == os.path.getsize(LOGS_FILE) - 1)
+
+async def run_snapshot():
+    # Un solo worker escribe; los demás omiten la pasada
+    global snapshot_write
+    captured = capture_snapshot_state()
+    if snapshot_is_current(captured):
+        return False
+    with open(SNAPSHOT_LOCK_FILE, 'a') as lock:
+        if fcntl:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        started = time.monotonic()
+        # shield: si se cancela la tarea, el hilo termina igual de escribir
+        snapshot_write = asyncio.get_event_loop().run_in_executor(None, write_snapshot, captured)
+        drivers, logs = await asyncio.shield(snapshot_write)
+    
+    print(f"📸 Snapshot v{captured['version']}: {drivers} choferes, {logs} registros "
+          f"en {time.monotonic() - started:.2f} s")
+    return True
+
+snapshot_write = None  # escritura en curso en un hilo
+
+async def snapshot_loop():
+    while True:
+        try:
+            await run_snapshot()
+        except Exception as e:
+            print(f"⚠️ Error al escribir el snapshot: {e}")
+        await asyncio.sleep(SNAPSHOT_INTERVAL_SECONDS)
+
+state_snapshot = None
+
+def load_snapshot():
+    # El snapshot solo sirve si el registro de cambios es el mismo archivo
+    # (sin compactar desde entonces) y entry_logs.json solo creció
+    if state.shared or not os.path.exists(SNAPSHOT_FILE):
+        return None
+    try:
+        snapshot = StateSnapshot(SNAPSHOT_FILE)
+    except (ValueError, struct.error, OSError) as e:
+        print(f"⚠️ Snapshot ignorado: {e}")
+        return None
+    
+    changes = os.stat(DRIVER_CHANGES_FILE)
+    if changes.st_ino != snapshot.changes_inode or changes.st_size < snapshot.changes_offset:
+        snapshot.close()
+        return None
+    return snapshot
+
+def read_logs_tail(snapshot):
+    # Registros añadidos a entry_logs.json después del snapshot, leyendo
+    # solo los bytes a partir del "]" que cerraba el arreglo
+    start = snapshot.logs_offset - len(snapshot.logs_tail)
+    with open(LOGS_FILE, 'rb') as f:
+        f.seek(start)
+        if f.read(len(snapshot.logs_tail)) != snapshot.logs_tail:
+            return None
+        rest = f.read()
+    if rest == b"]":
+        return []
+    if snapshot.logs_tail.endswith(b"["):
+        rest = b"," + rest  # el arreglo estaba vacío al escribir el snapshot
+    if not rest.startswith(b","):
+        return None
+    try:
+        return [LogEntry.from_dict(entry) for entry in serializer.loads(b"[" + rest[1:])]
+    except ValueError:
+        return None
+
+def warm_start():
+    global state_snapshot, driver_changes_offset, driver_changes_inode
+    global driver_changes_floor, driver_changes_base
+    snapshot = load_snapshot()
+    if snapshot is None:
+        return False
+    tail = read_logs_tail(snapshot)
+    if tail is None:
+        snapshot.close()
+        return False
+    
+    # Los choferes se quedan en el mapa; al backend solo van las tablas pequeñas
+    state_snapshot = snapshot
+    for code, reason in snapshot.items("revoked"):
+        state.sadd("revoked", code)
+        state.set(f"revoked:{code}", reason.decode("utf-8"))
+    for code, entry in snapshot.items("yard"):
+        state.sadd("yard", code)
+        state.set(f"yard:{code}", entry.decode("utf-8"))
+    for code, stats in snapshot.items("dwell"):
+        state.set(f"dwell:{code}", stats.decode("utf-8"))
+    state.set("yard:initialized", "1")
+    
+    # Reaplicar solo lo posterior al snapshot
+    state.sadd("events", *[log.event_id for log in tail if log.event_id])
+    replay_occupancy(tail)
+    driver_changes_offset = snapshot.changes_offset
+    driver_changes_inode = snapshot.changes_inode
+    driver_changes_floor = snapshot.floor
+    driver_changes_base = snapshot.version
+    refresh_state(force=True)
+    rebuild_revocation_filter()
+    return True
+
+startup_began = time.monotonic()
+if warm_start():
+    startup_report = {
+        "source": "snapshot",
+        "snapshot_version": state_snapshot.version,
+        "changes_replayed": len(driver_changes)
+    }
+else:
+    seed_state()
+    # Con estado compartido solo el primer nodo reconstruye
+    if state.setnx("yard:initialized", "1"):
+        rebuild_occupancy()
+    startup_report = {"source": "disk"}
+startup_report["seconds"] = round(time.monotonic() - startup_began, 3)
+
+# Citas: índice de intervalos por código. Las ventanas de cada código están
+# ordenadas por inicio junto con el máximo acumulado de sus fines, así que
+# la consulta es una búsqueda binaria aunque haya decenas de miles por día
+class AppointmentIndex:
+    def __init__(self):
+        self.windows = {}
+        self.starts = {}
+        self.max_ends = {}
+    
+    def add(self, code, start, end, dock=""):
+        self.windows.setdefault(code, []).append((start, end, dock))
+    
+    def build(self):
+        for code, windows in self.windows.items():
+            windows.sort()
+            self.starts[code] = [window[0] for window in windows]
+            max_ends = []
+            for window in windows:
+                max_ends.append(max(window[1], max_ends[-1]) if max_ends else window[1])
+            self.max_ends[code] = max_ends
+        return self
+    
+    def check(self, code, moment, tolerance=timedelta(0)):
+        # Devuelve (llegada, ventana): "a tiempo", "anticipada" o "tardía";
+        # (None, None) si el código no tiene citas
+        windows = self.windows.get(code)
+        if not windows:
+            return None, None
+        
+        max_ends = self.max_ends[code]
+        i = bisect.bisect_right(self.starts[code], moment + tolerance)
+        if i and max_ends[i - 1] >= moment - tolerance:
+            j = i - 1
+            while windows[j][1] < moment - tolerance:
+                j -= 1
+            return "a tiempo", windows[j]
+        
+        # Fuera de toda ventana: comparar con la más cercana
+        previous = None
+        if i:
+            previous = next(w for w in reversed(windows[:i]) if w[1] == max_ends[i - 1])
+        upcoming = windows[i] if i < len(windows) else None
+        if upcoming and (previous is None or upcoming[0] - moment <= moment - previous[1]):
+            return "anticipada", upcoming
+        return "tardía", previous
+    
+    def __len__(self):
+        return sum(len(windows) for windows in self.windows.values())
+
+def parse_local_time(value):
+    # Los registros usan hora local sin zona: una hora con desfase
+    # (+00:00, Z) se convierte a local para poder compararla
+    moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+def parse_appointment_row(row):
+    code = (row.get("qr_code") or "").strip()
+    if not code:
+        raise ValueError("falta qr_code")
+    start = parse_local_time(row["start"])
+    end = parse_local_time(row["end"])
+    if end <= start:
+        raise ValueError("end debe ser posterior a start")
+    return code, start, end, (row.get("dock") or "").strip()
+
+appointments = AppointmentIndex()
+appointments_mtime = None
+
+def appointments_cutoff():
+    return datetime.now() - timedelta(days=APPOINTMENT_RETENTION_DAYS)
+
+def refresh_appointments():
+    # Se ejecuta en un hilo desde appointments_loop: releer un archivo grande
+    # no debe detener el primer escaneo después de una carga
+    global appointments, appointments_mtime
+    mtime = os.path.getmtime(APPOINTMENTS_FILE) if os.path.exists(APPOINTMENTS_FILE) else None
+    if mtime == appointments_mtime:
+        return
+    
+    index = AppointmentIndex()
+    if mtime is not None:
+        load_appointments_file(index)
+    appointments = index.build()
+    appointments_mtime = mtime
+
+def load_appointments_file(index):
+    # Las ventanas terminadas antes de APPOINTMENT_RETENTION_DAYS no se indexan
+    cutoff = appointments_cutoff()
+    with open(APPOINTMENTS_FILE, newline='', encoding='utf-8') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            try:
+                code, start, end, dock = parse_appointment_row(row)
+            except (ValueError, KeyError, AttributeError) as e:
+                print(f"⚠️ {APPOINTMENTS_FILE} línea {line} ignorada: {e}")
+                continue
+            if end >= cutoff:
+                index.add(code, start, end, dock)
+
+def save_appointments_file(index):
+    # Se reescribe con lo que quedó en el índice, así el archivo no crece
+    # con citas vencidas
+    tmp_path = f"{APPOINTMENTS_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['qr_code', 'start', 'end', 'dock'])
+        for code, windows in index.windows.items():
+            writer.writerows([code, start.isoformat(sep=" "), end.isoformat(sep=" "), dock]
+                             for start, end, dock in windows)
+    os.replace(tmp_path, APPOINTMENTS_FILE)
+
+async def appointments_loop():
+    while True:
+        await asyncio.sleep(APPOINTMENTS_REFRESH_SECONDS)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, refresh_appointments)
+        except Exception as e:
+            print(f"⚠️ Error al releer las citas: {e}")
+
+def check_appointment(code, timestamp):
+    tolerance = timedelta(minutes=APPOINTMENT_TOLERANCE_MINUTES)
+    return appointments.check(code, parse_log_timestamp(timestamp), tolerance)
+
+# Analítica de registros: columnas de entry_logs.csv en un DataFrame que se
+# amplía leyendo solo los bytes nuevos; las indicadoras por estado se
+# calculan una vez por segmento y cada consulta es un filtro y un groupby
+class LogColumns:
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+    
+    def reset(self):
+        self.frame = parse_log_segment(b"")
+        self.offset = 0
+        self.inode = None
+    
+    def refresh(self):
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            # Archivo reemplazado o truncado: volver a leer completo
+            self.reset()
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return self.frame
+        
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # la última línea puede estar a medio escribir
+        if end == 0:
+            return self.frame
+        chunk = data[:end]
+        if self.offset == 0:
+            chunk = chunk[chunk.find(b"\n") + 1:]  # encabezado
+        self.offset += end
+        
+        segment = parse_log_segment(chunk)
+        if not len(self.frame):
+            self.frame = segment.reset_index(drop=True)
+        elif len(segment):
+            # Añadir al final las categorías nuevas del segmento, sin recodificar
+            # lo ya cargado, para que la unión conserve el tipo categórico
+            extended = {}
+            for column in ("driver_name", "qr_code", "status"):
+                known = self.frame[column].cat.categories
+                new = segment[column].cat.categories.difference(known)
+                extended[column] = self.frame[column].cat.add_categories(new) if len(new) else self.frame[column]
+                segment[column] = segment[column].cat.set_categories(extended[column].cat.categories)
+            self.frame = pd.concat([self.frame.assign(**extended), segment], ignore_index=True)
+        return self.frame
+
+ANALYTICS_FLAGS = ("entries", "exits", "rejected", "early", "late")
+
+def parse_log_segment(chunk):
+    columns = ["timestamp", "driver_name", "qr_code", "status"]
+    if chunk:
+        rows = pd.read_csv(io.BytesIO(chunk), header=None, names=columns + ["notes"], usecols=columns,
+                           dtype=str, keep_default_na=False)
+    else:
+        rows = pd.DataFrame({column: pd.Series(dtype=str) for column in columns})
+    timestamps = pd.to_datetime(rows["timestamp"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    status = rows["status"]
+    segment = pd.DataFrame({
+        "timestamp": timestamps,
+        "driver_name": rows["driver_name"].astype("category"),
+        "qr_code": rows["qr_code"].astype("category"),
+        "status": status.astype("category"),
+        "entries": status.isin(ENTRY_STATUSES),
+        "exits": status.isin(EXIT_STATUSES),
+        "rejected": ~status.isin(AUTHORIZED_STATUSES),
+        "early": status.eq("Llegada anticipada"),
+        "late": status.eq("Llegada tardía")
+    })
+    return segment[segment["timestamp"].notna()].copy()
+
+log_columns = LogColumns(LOGS_CSV_FILE)
+
+def summarize_logs(frame):
+    total = len(frame)
+    counts = frame[list(ANALYTICS_FLAGS)].sum()
+    summary = {"total": total}
+    summary.update({flag: int(counts[flag]) for flag in ANALYTICS_FLAGS})
+    summary["rejection_rate"] = round(summary["rejected"] / total, 4) if total else 0.0
+    return summary
+
+def analyze_logs(frame, group_by=None, limit=ANALYTICS_GROUP_LIMIT):
+    result = {"summary": summarize_logs(frame)}
+    
+    # Histogramas de llegadas (entradas autorizadas) por hora y día de la semana (lunes = 0)
+    arrivals = frame.loc[frame["entries"], "timestamp"]
+    result["arrivals"] = {
+        "by_hour": arrivals.dt.hour.value_counts().reindex(range(24), fill_value=0).tolist(),
+        "by_weekday": arrivals.dt.dayofweek.value_counts().reindex(range(7), fill_value=0).tolist()
+    }
+    if group_by is None:
+        return result
+    
+    keys = {
+        "driver": frame["qr_code"],
+        "status": frame["status"],
+        "hour": frame["timestamp"].dt.hour.rename("hour"),
+        "day": frame["timestamp"].dt.normalize().rename("day")
+    }[group_by]
+    grouped = frame[list(ANALYTICS_FLAGS)].groupby(keys, observed=True, sort=True)
+    table = grouped.sum()
+    table.insert(0, "total", grouped.size())
+    table["rejection_rate"] = (table["rejected"] / table["total"]).round(4)
+    if group_by in ("driver", "status"):
+        table = table.sort_values("total", ascending=False, kind="stable")
+    
+    names = frame.groupby("qr_code", observed=True)["driver_name"].last() if group_by == "driver" else None
+    groups = []
+    for key, row in table.head(limit).iterrows():
+        group = {"key": key.strftime("%Y-%m-%d") if group_by == "day" else
+                 int(key) if group_by == "hour" else str(key)}
+        if names is not None:
+            group["driver_name"] = str(names[key])
+        group.update({column: int(row[column]) for column in ("total",) + ANALYTICS_FLAGS})
+        group["rejection_rate"] = float(row["rejection_rate"])
+        groups.append(group)
+    result["groups"] = groups
+    result["group_count"] = len(table)
+    return result
 
 def generate_qr_code(driver_name: str):
     # Crear un hash único basado en el nombre y timestamp
@@ -98,17 +1533,231 @@ def generate_qr_code(driver_name: str):
     
     # Guardar información del conductor
     drivers = load_drivers()
-    drivers[qr_hash] = {
-        "name": driver_name,
-        "code": qr_hash,
-        "generated_at": timestamp,
-        "qr_image": qr_path,
-        "used": False
-    }
+    drivers[qr_hash] = Driver(driver_name, qr_hash, timestamp, qr_path)
     save_drivers(drivers)
+    record_driver_change("upsert", qr_hash, drivers[qr_hash].to_dict())
+    put_driver_state(drivers[qr_hash])
     
     return qr_hash, qr_path
 
+def normalize_driver_name(name):
+    return " ".join(name.split()).casefold()
+
+def expire_drivers(codes):
+    # Vencer es revocar: el chofer y su imagen se conservan y
+    # /api/admin/reinstate lo reactiva si vuelve
+    for code in codes:
+        record_driver_change("revoke", code, reason=DRIVER_EXPIRY_REASON)
+        set_revoked(code, DRIVER_EXPIRY_REASON)
+
+def last_authorized_scans():
+    # Último paso autorizado de cada código (se ejecuta en un hilo)
+    last_seen = {}
+    for entry in read_json(LOGS_FILE):
+        if entry["status"] in AUTHORIZED_STATUSES:
+            seen = datetime.fromisoformat(entry["timestamp"])
+            if entry["qr_code"] not in last_seen or seen > last_seen[entry["qr_code"]]:
+                last_seen[entry["qr_code"]] = seen
+    return last_seen
+
+async def collect_garbage():
+    report = {
+        "started_at": datetime.now().isoformat(),
+        "drivers": 0,               # choferes en drivers.json: la recolección no lo reduce
+        "expired_drivers": [],
+        "duplicate_names": [],
+        "orphaned_images": 0,
+        "bytes_reclaimed": 0,
+        "changes_compacted": 0
+    }
+    now = datetime.now()
+    last_seen = await asyncio.get_event_loop().run_in_executor(None, last_authorized_scans)
+    
+    drivers = load_drivers()
+    report["drivers"] = len(drivers)
+    expired = set()
+    if DRIVER_EXPIRY_DAYS is not None:
+        expiry = now - timedelta(days=DRIVER_EXPIRY_DAYS)
+        refresh_state(force=True)
+        revoked = state.smembers("revoked")
+        for code, driver in drivers.items():
+            if (code not in revoked and
+                    max(datetime.fromisoformat(driver.generated_at), last_seen.get(code, datetime.min)) < expiry):
+                expired.add(code)
+    
+    # Duplicados por nombre: el nombre no identifica a una persona (dos choferes
+    # pueden llamarse igual), así que solo se reportan para que un administrador
+    # decida; no se revoca ni borra nada
+    by_name = {}
+    for code, driver in drivers.items():
+        if code not in expired:
+            by_name.setdefault(normalize_driver_name(driver.name), []).append(driver)
+    for group in by_name.values():
+        if len(group) < 2:
+            continue
+        report["duplicate_names"].append({
+            "name": group[0].name,
+            "codes": [
+                {"code": driver.code, "generated_at": driver.generated_at,
+                 "last_seen": last_seen[driver.code].isoformat() if driver.code in last_seen else None}
+                for driver in sorted(group, key=lambda d: d.generated_at)
+            ]
+        })
+    
+    report["expired_drivers"] = sorted(expired)
+    for start in range(0, len(report["expired_drivers"]), GC_BATCH_SIZE):
+        expire_drivers(report["expired_drivers"][start:start + GC_BATCH_SIZE])
+        await asyncio.sleep(0)
+    
+    # Imágenes sin chofer asociado
+    referenced = {os.path.normpath(driver.qr_image) for driver in load_drivers().values()}
+    min_mtime = time.time() - ORPHAN_MIN_AGE_SECONDS
+    with os.scandir("static/qr_codes") as entries:
+        for i, entry in enumerate(entries):
+            path = os.path.normpath(os.path.join("static/qr_codes", entry.name))
+            if (entry.name.startswith("qr_") and entry.name.endswith(".png")
+                    and path not in referenced and entry.stat().st_mtime < min_mtime):
+                report["bytes_reclaimed"] += entry.stat().st_size
+                os.remove(entry.path)
+                report["orphaned_images"] += 1
+            if i % GC_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
+    
+    report["changes_compacted"] = compact_driver_changes()
+    report["finished_at"] = datetime.now().isoformat()
+    return report
+
+last_gc_report = None
+
+async def run_garbage_collection():
+    # Solo un worker a la vez; los demás omiten la pasada
+    global last_gc_report
+    with open(GC_LOCK_FILE, 'a') as lock:
+        if fcntl:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        last_gc_report = await collect_garbage()
+    
+    print(f"🧹 GC: {len(last_gc_report['expired_drivers'])} vencidos, "
+          f"{len(last_gc_report['duplicate_names'])} nombres duplicados, "
+          f"{last_gc_report['orphaned_images']} imágenes huérfanas, "
+          f"{last_gc_report['bytes_reclaimed']} bytes liberados")
+    return last_gc_report
+
+async def garbage_collection_loop():
+    while True:
+        await asyncio.sleep(GC_INTERVAL_SECONDS)
+        try:
+            await run_garbage_collection()
+        except Exception as e:
+            print(f"⚠️ Error en la recolección de basura: {e}")
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    def consume(self, now, tokens=1):
+        # Devuelve 0 si se admite o los segundos a esperar si no hay fichas
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0
+        return (tokens - self.tokens) / self.rate if self.rate > 0 else RATE_LIMITS_REFRESH_SECONDS
+
+rate_limits = dict(DEFAULT_RATE_LIMITS)
+rate_limits_mtime = None
+rate_limits_checked_at = 0.0
+rate_buckets = OrderedDict()
+requests_in_flight = 0
+
+def refresh_rate_limits():
+    global rate_limits, rate_limits_mtime, rate_limits_checked_at
+    now = time.monotonic()
+    if now - rate_limits_checked_at < RATE_LIMITS_REFRESH_SECONDS:
+        return
+    rate_limits_checked_at = now
+    
+    mtime = os.path.getmtime(RATE_LIMITS_FILE) if os.path.exists(RATE_LIMITS_FILE) else None
+    if mtime == rate_limits_mtime:
+        return
+    
+    try:
+        rate_limits = {**DEFAULT_RATE_LIMITS, **(read_json(RATE_LIMITS_FILE) if mtime else {})}
+    except (ValueError, TypeError) as e:
+        # Un archivo mal formado no debe tumbar la validación: se conserva la configuración anterior
+        print(f"⚠️ {RATE_LIMITS_FILE} inválido, se mantiene la configuración actual: {e}")
+    rate_limits_mtime = mtime
+    rate_buckets.clear()
+
+def rate_client_id(request):
+    # Devuelve (clave del balde, caseta). X-Gate-Id lo elige el cliente: solo
+    # se respeta para casetas declaradas en "gates", y aun así junto con la IP,
+    # para que otro equipo que envíe el mismo encabezado no agote las fichas
+    # de la caseta real. Un valor no declarado cuenta contra la IP
+    host = request.client.host if request.client else "desconocido"
+    gate = request.headers.get("X-Gate-Id")
+    if gate and gate in rate_limits.get("gates", {}):
+        return (gate, host), gate
+    return host, None
+
+def get_rate_bucket(client_id, gate=None):
+    bucket = rate_buckets.get(client_id)
+    if bucket is not None:
+        rate_buckets.move_to_end(client_id)
+        return bucket
+    if len(rate_buckets) >= RATE_BUCKETS_MAX:
+        rate_buckets.popitem(last=False)
+    limits = {**rate_limits, **rate_limits.get("gates", {}).get(gate, {})}
+    bucket = rate_buckets[client_id] = TokenBucket(float(limits["rate"]), float(limits["burst"]))
+    return bucket
+
+def too_many_requests(retry_after, message):
+    return JSONResponse(
+        status_code=429,
+        content={"success": False, "message": message},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    global requests_in_flight
+    if request.url.path not in RATE_LIMITED_PATHS:
+        return await call_next(request)
+    
+    if draining:
+        return JSONResponse(
+            status_code=503,
+            content={"success": False, "message": "Servidor en mantenimiento, intente de nuevo"},
+            headers={"Retry-After": str(DRAIN_GRACE_SECONDS)}
+        )
+    
+    refresh_rate_limits()
+    
+    # Rechazo rápido antes de leer el cuerpo o tocar los archivos de logs
+    if requests_in_flight >= rate_limits["max_concurrent"]:
+        return too_many_requests(1, "Servidor ocupado, intente de nuevo")
+    
+    # Cada solicitud paga una ficha; /api/sync paga además una por cada
+    # evento adicional del lote (ver api_sync)
+    bucket = request.state.rate_bucket = get_rate_bucket(*rate_client_id(request))
+    retry_after = bucket.consume(time.monotonic())
+    if retry_after:
+        return too_many_requests(retry_after, "Demasiadas solicitudes desde esta caseta")
+    
+    requests_in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        requests_in_flight -= 1
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return """
@@ -240,7 +1889,7 @@ async def home(request: Request):
                 
                 <a href="/scan" class="btn btn-secondary">
                     <span class="icon">📷</span>
-                    Escanear QR - Entrada
+                    Escanear QR - Entrada/Salida
                 </a>
                 
                 <a href="/logs" class="btn" style="background: linear-gradient(135deg, #8e44ad, #7d3c98); color: white;">
@@ -600,6 +2249,51 @@ async def scan_page():
                 color: #666;
                 margin-top: 10px;
             }
+            
+            .sync-status {
+                text-align: center;
+                font-size: 14px;
+                color: #666;
+                margin-top: 20px;
+            }
+            
+            .mode-toggle {
+                display: flex;
+                gap: 10px;
+                justify-content: center;
+                margin-bottom: 20px;
+            }
+            
+            .mode-toggle label {
+                padding: 12px 25px;
+                border: 2px solid #e1e8ed;
+                border-radius: 10px;
+                cursor: pointer;
+                font-weight: 600;
+                color: #2c3e50;
+            }
+            
+            .mode-toggle input {
+                display: none;
+            }
+            
+            .mode-toggle input:checked + span {
+                color: #27ae60;
+            }
+            
+            .mode-toggle label:has(input:checked) {
+                border-color: #27ae60;
+                background: #eafaf1;
+            }
+            
+            .camera {
+                display: none;
+                width: 100%;
+                max-width: 480px;
+                margin: 0 auto 20px;
+                border-radius: 15px;
+                background: #000;
+            }
         </style>
     </head>
     <body>
@@ -611,8 +2305,15 @@ async def scan_page():
                 <p>Escanee o ingrese el código QR del chofer</p>
             </div>
             
+            <div class="mode-toggle">
+                <label><input type="radio" name="scanMode" value="entrada" checked><span>🚛 Entrada</span></label>
+                <label><input type="radio" name="scanMode" value="salida"><span>🏁 Salida</span></label>
+            </div>
+            
             <div class="scan-section">
-                <p style="color: #666; margin-bottom: 20px;">
+                <video id="camera" class="camera" muted playsinline></video>
+                <button type="button" class="btn" id="cameraBtn" style="display: none;">📷 Activar Cámara</button>
+                <p id="scanHint" style="color: #666; margin-top: 20px;">
                     📱 Use un lector de códigos QR en su dispositivo móvil o ingrese manualmente el código
                 </p>
             </div>
@@ -622,7 +2323,7 @@ async def scan_page():
                 <form id="validateForm">
                     <div class="input-group">
                         <input type="text" id="qrCode" placeholder="Código QR o datos escaneados" required>
-                        <button type="submit" class="btn">Validar Entrada</button>
+                        <button type="submit" class="btn" id="submitBtn">Validar Entrada</button>
                     </div>
                 </form>
             </div>
@@ -630,85 +2331,411 @@ async def scan_page():
             <div id="result" class="result">
                 <div id="resultContent"></div>
             </div>
+            
+            <div id="syncStatus" class="sync-status"></div>
         </div>
         
         <script>
-            document.getElementById('validateForm').addEventListener('submit', async (e) => {
-                e.preventDefault();
-                
-                const qrCode = document.getElementById('qrCode').value.trim();
+            // Cola local (IndexedDB) para seguir validando sin conexión
+            const DB_NAME = 'registro-camiones';
+            const REQUEST_TIMEOUT_MS = 3000;
+            const SYNC_INTERVAL_MS = 10000;
+            const SYNC_BATCH_SIZE = 200;
+            
+            // Identificador de caseta (?gate=...), recordado en este dispositivo
+            const gateId = new URLSearchParams(location.search).get('gate') || localStorage.getItem('gateId') || '';
+            if (gateId) {
+                localStorage.setItem('gateId', gateId);
+            }
+            const gateHeaders = gateId ? { 'X-Gate-Id': gateId } : {};
+            
+            // Modo de escaneo (?mode=salida para casetas de salida)
+            let scanMode = new URLSearchParams(location.search).get('mode') === 'salida' ? 'salida' : 'entrada';
+            
+            function setScanMode(mode) {
+                scanMode = mode;
+                document.querySelector(`input[name="scanMode"][value="${mode}"]`).checked = true;
+                document.getElementById('submitBtn').textContent = mode === 'salida' ? 'Registrar Salida' : 'Validar Entrada';
+            }
+            
+            document.querySelectorAll('input[name="scanMode"]').forEach(input => {
+                input.addEventListener('change', () => setScanMode(input.value));
+            });
+            setScanMode(scanMode);
+            
+            const localDrivers = new Map();
+            let pendingEvents = 0;
+            let online = navigator.onLine;
+            let syncing = false;
+            
+            const dbPromise = new Promise((resolve, reject) => {
+                const req = indexedDB.open(DB_NAME, 1);
+                req.onupgradeneeded = () => {
+                    const db = req.result;
+                    db.createObjectStore('queue', { keyPath: 'event_id' });
+                    db.createObjectStore('drivers', { keyPath: 'code' });
+                    db.createObjectStore('meta');
+                };
+                req.onsuccess = () => resolve(req.result);
+                req.onerror = () => reject(req.error);
+            });
+            
+            function idbRequest(storeName, mode, action) {
+                return dbPromise.then(db => new Promise((resolve, reject) => {
+                    const req = action(db.transaction(storeName, mode).objectStore(storeName));
+                    req.onsuccess = () => resolve(req.result);
+                    req.onerror = () => reject(req.error);
+                }));
+            }
+            
+            function idbBatch(storeName, action) {
+                return dbPromise.then(db => new Promise((resolve, reject) => {
+                    const tx = db.transaction(storeName, 'readwrite');
+                    action(tx.objectStore(storeName));
+                    tx.oncomplete = () => resolve();
+                    tx.onerror = () => reject(tx.error);
+                }));
+            }
+            
+            function newEventId() {
+                if (crypto.randomUUID) {
+                    return crypto.randomUUID();
+                }
+                return Date.now().toString(36) + Math.random().toString(36).slice(2);
+            }
+            
+            function formatTimestamp(date) {
+                const pad = n => String(n).padStart(2, '0');
+                return `${date.getFullYear()}-${pad(date.getMonth() + 1)}-${pad(date.getDate())} ` +
+                    `${pad(date.getHours())}:${pad(date.getMinutes())}:${pad(date.getSeconds())}`;
+            }
+            
+            async function fetchWithTimeout(url, options) {
+                const controller = new AbortController();
+                const timer = setTimeout(() => controller.abort(), REQUEST_TIMEOUT_MS);
+                try {
+                    return await fetch(url, { ...options, signal: controller.signal });
+                } finally {
+                    clearTimeout(timer);
+                }
+            }
+            
+            function validateLocally(qrCode, mode) {
+                // Misma lógica que validate_qr en el servidor, contra la copia local
+                let code = qrCode.trim();
+                try {
+                    const parsed = JSON.parse(qrCode);
+                    if (parsed && typeof parsed === 'object') {
+                        if (!parsed.code || !parsed.driver_name) {
+                            return { success: false, message: 'Formato de QR inválido' };
+                        }
+                        code = parsed.code;
+                    }
+                } catch (error) {
+                    // No es JSON: se asume que es solo el código
+                }
                 
-                if (!qrCode) {
-                    alert('Por favor ingrese el código QR');
+                const driver = localDrivers.get(code);
+                if (driver) {
+                    const message = mode === 'salida' ? 'Salida registrada' : 'Entrada autorizada';
+                    return { success: true, driver_name: driver.name, qr_code: code, mode: mode, message: message };
+                }
+                return { success: false, message: 'Código QR no válido o no registrado', qr_code: code };
+            }
+            
+            function updateSyncStatus() {
+                const icon = online ? '🟢 En línea' : '🟠 Sin conexión';
+                const pending = pendingEvents ? ` · ${pendingEvents} escaneo(s) pendientes de sincronizar` : '';
+                document.getElementById('syncStatus').textContent = icon + pending;
+            }
+            
+            async function applyDriverChanges(data) {
+                // Los cambios con registro de chofer lo agregan; los demás lo retiran
+                await idbBatch('drivers', store => {
+                    if (data.full) {
+                        store.clear();
+                    }
+                    Object.values(data.drivers).forEach(driver => store.put(driver));
+                    data.changes.forEach(change => change.driver ? store.put(change.driver) : store.delete(change.code));
+                });
+                if (data.full) {
+                    localDrivers.clear();
+                }
+                Object.values(data.drivers).forEach(driver => localDrivers.set(driver.code, driver));
+                data.changes.forEach(change => change.driver ? localDrivers.set(change.code, change.driver) : localDrivers.delete(change.code));
+                await idbRequest('meta', 'readwrite', store => store.put(data.version, 'driversVersion'));
+            }
+            
+            async function syncNow() {
+                if (syncing) {
                     return;
                 }
+                syncing = true;
+                let more = false;
+                let retryAfter = 0;
                 
                 try {
-                    const response = await fetch('/api/validate-qr', {
+                    const queued = await idbRequest('queue', 'readonly', store => store.getAll());
+                    const since = await idbRequest('meta', 'readonly', store => store.get('driversVersion'));
+                    const batch = queued.slice(0, SYNC_BATCH_SIZE);
+                    
+                    const response = await fetchWithTimeout('/api/sync', {
                         method: 'POST',
                         headers: {
-                            'Content-Type': 'application/x-www-form-urlencoded',
+                            'Content-Type': 'application/json',
+                            ...gateHeaders
                         },
-                        body: `qr_data=${encodeURIComponent(qrCode)}`
+                        body: JSON.stringify({ events: batch, since: since === undefined ? null : since })
                     });
-                    
-                    const data = await response.json();
-                    const resultDiv = document.getElementById('result');
-                    const contentDiv = document.getElementById('resultContent');
-                    
-                    resultDiv.style.display = 'block';
-                    
-                    if (data.success) {
-                        resultDiv.className = 'result success';
-                        contentDiv.innerHTML = `
-                            <div style="font-size: 24px; margin-bottom: 15px;">✅ ENTRADA VÁLIDA</div>
-                            <div class="driver-info">
-                                <div style="font-size: 20px; margin-bottom: 10px;">
-                                    <strong>Chofer:</strong> ${data.driver_name}
-                                </div>
-                                <div style="font-size: 16px; color: #666;">
-                                    <strong>Código:</strong> ${data.qr_code}
-                                </div>
-                                <div class="timestamp">
-                                    Registrado: ${new Date().toLocaleString('es-ES')}
-                                </div>
-                            </div>
-                        `;
-                        
-                        // Limpiar campo después del éxito
-                        document.getElementById('qrCode').value = '';
-                        
-                        // Auto-ocultar resultado después de 5 segundos
-                        setTimeout(() => {
-                            resultDiv.style.display = 'none';
-                        }, 5000);
-                        
+                    if (response.status === 429) {
+                        // Límite de la caseta: hay conexión, se reintenta cuando indique el servidor
+                        retryAfter = Number(response.headers.get('Retry-After')) || 1;
+                    } else if (!response.ok) {
+                        throw new Error(`HTTP ${response.status}`);
                     } else {
-                        resultDiv.className = 'result error';
-                        contentDiv.innerHTML = `
-                            <div style="font-size: 24px; margin-bottom: 15px;">❌ QR INVÁLIDO</div>
-                            <div style="font-size: 16px;">
-                                ${data.message}
+                        const data = await response.json();
+                        const done = data.accepted.concat(data.duplicates);
+                        await idbBatch('queue', store => done.forEach(id => store.delete(id)));
+                        await applyDriverChanges(data);
+                        
+                        pendingEvents = queued.length - done.length;
+                        if (data.throttled.length) {
+                            retryAfter = data.retry_after || 1;
+                        } else {
+                            more = data.has_more || (batch.length === SYNC_BATCH_SIZE && pendingEvents > 0);
+                        }
+                    }
+                    online = true;
+                } catch (error) {
+                    // Se reintenta en el siguiente ciclo
+                    online = false;
+                } finally {
+                    syncing = false;
+                    updateSyncStatus();
+                }
+                
+                if (more) {
+                    syncNow();
+                } else if (retryAfter) {
+                    setTimeout(syncNow, retryAfter * 1000);
+                }
+            }
+            
+            async function loadLocalState() {
+                const drivers = await idbRequest('drivers', 'readonly', store => store.getAll());
+                drivers.forEach(driver => localDrivers.set(driver.code, driver));
+                pendingEvents = await idbRequest('queue', 'readonly', store => store.count());
+                updateSyncStatus();
+            }
+            
+            function showResult(data, offline) {
+                const resultDiv = document.getElementById('result');
+                const contentDiv = document.getElementById('resultContent');
+                const offlineNote = offline ? ' (sin conexión, pendiente de sincronizar)' : '';
+                const title = data.mode === 'salida' ? '✅ SALIDA REGISTRADA' : '✅ ENTRADA VÁLIDA';
+                const dwell = data.dwell_seconds != null
+                    ? `<div style="font-size: 16px; color: #666;"><strong>Permanencia:</strong> ${Math.round(data.dwell_seconds / 60)} min</div>`
+                    : '';
+                
+                resultDiv.style.display = 'block';
+                
+                if (data.success) {
+                    resultDiv.className = 'result success';
+                    contentDiv.innerHTML = `
+                        <div style="font-size: 24px; margin-bottom: 15px;">${title}</div>
+                        <div class="driver-info">
+                            <div style="font-size: 20px; margin-bottom: 10px;">
+                                <strong>Chofer:</strong> ${data.driver_name}
+                            </div>
+                            <div style="font-size: 16px; color: #666;">
+                                <strong>Código:</strong> ${data.qr_code}
                             </div>
+                            ${dwell}
+                            ${data.warning ? `<div style="font-size: 16px; color: #b9770e; margin-top: 10px;">⚠️ ${data.warning}</div>` : ''}
                             <div class="timestamp">
-                                Intento registrado: ${new Date().toLocaleString('es-ES')}
+                                Registrado: ${new Date().toLocaleString('es-ES')}${offlineNote}
                             </div>
-                        `;
-                    }
-                } catch (error) {
-                    const resultDiv = document.getElementById('result');
-                    const contentDiv = document.getElementById('resultContent');
+                        </div>
+                    `;
                     
-                    resultDiv.style.display = 'block';
+                    // Limpiar campo después del éxito
+                    document.getElementById('qrCode').value = '';
+                    
+                    // Auto-ocultar resultado después de 5 segundos
+                    setTimeout(() => {
+                        resultDiv.style.display = 'none';
+                    }, 5000);
+                    
+                } else {
                     resultDiv.className = 'result error';
                     contentDiv.innerHTML = `
-                        <div style="font-size: 24px; margin-bottom: 15px;">⚠️ ERROR DE CONEXIÓN</div>
+                        <div style="font-size: 24px; margin-bottom: 15px;">❌ QR INVÁLIDO</div>
                         <div style="font-size: 16px;">
-                            ${error.message}
+                            ${data.message}
+                        </div>
+                        <div class="timestamp">
+                            Intento registrado: ${new Date().toLocaleString('es-ES')}${offlineNote}
                         </div>
                     `;
                 }
+            }
+            
+            async function submitScan(qrCode) {
+                const scanEvent = {
+                    event_id: newEventId(),
+                    qr_data: qrCode,
+                    scanned_at: formatTimestamp(new Date()),
+                    gate: gateId || null,
+                    mode: scanMode
+                };
+                
+                if (online) {
+                    try {
+                        const response = await fetchWithTimeout('/api/validate-qr', {
+                            method: 'POST',
+                            headers: {
+                                'Content-Type': 'application/x-www-form-urlencoded',
+                                ...gateHeaders
+                            },
+                            body: `qr_data=${encodeURIComponent(qrCode)}&event_id=${encodeURIComponent(scanEvent.event_id)}&mode=${scanMode}`
+                        });
+                        if (!response.ok) {
+                            throw new Error(`HTTP ${response.status}`);
+                        }
+                        
+                        showResult(await response.json(), false);
+                        return;
+                    } catch (error) {
+                        online = false;
+                    }
+                }
+                
+                // Sin conexión: validar contra la copia local y encolar el escaneo
+                showResult(validateLocally(qrCode, scanMode), true);
+                await idbRequest('queue', 'readwrite', store => store.put(scanEvent));
+                pendingEvents += 1;
+                updateSyncStatus();
+            }
+            
+            document.getElementById('validateForm').addEventListener('submit', async (e) => {
+                e.preventDefault();
+                
+                const qrCode = document.getElementById('qrCode').value.trim();
+                
+                if (!qrCode) {
+                    alert('Por favor ingrese el código QR');
+                    return;
+                }
+                
+                await submitScan(qrCode);
+            });
+            
+            // Cámara: los cuadros se decodifican en un Web Worker (static/js/qr-worker.js),
+            // como máximo uno en curso y uno cada FRAME_INTERVAL_MS. Un mismo código
+            // que sigue a la vista solo se envía otra vez tras DEDUP_WINDOW_MS sin verlo
+            const FRAME_INTERVAL_MS = 200;
+            const DEDUP_WINDOW_MS = 5000;
+            
+            const video = document.getElementById('camera');
+            const cameraBtn = document.getElementById('cameraBtn');
+            const recentScans = new Map();
+            let qrWorker = null;
+            let cameraStream = null;
+            let decoding = false;
+            let lastFrameAt = 0;
+            
+            function isRepeatScan(value) {
+                const now = Date.now();
+                recentScans.forEach((seenAt, key) => {
+                    if (now - seenAt > DEDUP_WINDOW_MS) {
+                        recentScans.delete(key);
+                    }
+                });
+                // Cada lectura renueva la marca: el código queda suprimido mientras
+                // siga frente a la cámara
+                const repeated = recentScans.has(value);
+                recentScans.set(value, now);
+                return repeated;
+            }
+            
+            async function captureFrame(now) {
+                if (!cameraStream) {
+                    return;
+                }
+                requestAnimationFrame(captureFrame);
+                if (decoding || now - lastFrameAt < FRAME_INTERVAL_MS || video.readyState < 2) {
+                    return;
+                }
+                lastFrameAt = now;
+                decoding = true;
+                try {
+                    const frame = await createImageBitmap(video);
+                    qrWorker.postMessage(frame, [frame]);
+                } catch (error) {
+                    decoding = false;
+                }
+            }
+            
+            async function startCamera() {
+                try {
+                    cameraStream = await navigator.mediaDevices.getUserMedia({
+                        video: { facingMode: 'environment' },
+                        audio: false
+                    });
+                } catch (error) {
+                    alert('No se pudo acceder a la cámara: ' + error.message);
+                    return;
+                }
+                video.srcObject = cameraStream;
+                video.style.display = 'block';
+                await video.play();
+                cameraBtn.textContent = '⏹️ Detener Cámara';
+                requestAnimationFrame(captureFrame);
+            }
+            
+            function stopCamera() {
+                if (cameraStream) {
+                    cameraStream.getTracks().forEach(track => track.stop());
+                    cameraStream = null;
+                }
+                video.srcObject = null;
+                video.style.display = 'none';
+                cameraBtn.textContent = '📷 Activar Cámara';
+            }
+            
+            if (window.Worker && window.createImageBitmap && navigator.mediaDevices) {
+                qrWorker = new Worker('/static/js/qr-worker.js');
+                qrWorker.onmessage = (event) => {
+                    const message = event.data;
+                    if (message.type === 'ready') {
+                        // Sin BarcodeDetector el navegador no decodifica: queda el ingreso manual
+                        if (message.supported) {
+                            cameraBtn.style.display = 'inline-block';
+                            document.getElementById('scanHint').textContent =
+                                '📷 Apunte la cámara al código QR o ingréselo manualmente';
+                        }
+                        return;
+                    }
+                    decoding = false;
+                    if (message.value && !isRepeatScan(message.value)) {
+                        submitScan(message.value);
+                    }
+                };
+                cameraBtn.addEventListener('click', () => cameraStream ? stopCamera() : startCamera());
+                document.addEventListener('visibilitychange', () => {
+                    if (document.hidden) {
+                        stopCamera();
+                    }
+                });
+            }
+            
+            window.addEventListener('online', syncNow);
+            window.addEventListener('offline', () => {
+                online = false;
+                updateSyncStatus();
             });
+            loadLocalState().then(syncNow);
+            setInterval(syncNow, SYNC_INTERVAL_MS);
             
             // Auto-focus en el campo de entrada
             document.getElementById('qrCode').focus();
@@ -724,15 +2751,15 @@ async def logs_page():
     
     logs_html = ""
     for log in logs[:50]:  # Mostrar últimos 50 registros
-        status_class = "success" if log['status'] == "Entrada válida" else "error"
-        status_icon = "✅" if log['status'] == "Entrada válida" else "❌"
+        status_class = "success" if log.status in AUTHORIZED_STATUSES else "error"
+        status_icon = "✅" if log.status in AUTHORIZED_STATUSES else "❌"
         
         logs_html += f"""
         <tr class="{status_class}">
-            <td>{log['timestamp']}</td>
-            <td>{log['driver_name']}</td>
-            <td>{log['qr_code'][:12]}...</td>
-            <td>{status_icon} {log['status']}</td>
+            <td>{log.timestamp}</td>
+            <td>{log.driver_name}</td>
+            <td>{log.qr_code[:12]}...</td>
+            <td>{status_icon} {log.status}</td>
         </tr>
         """
     
@@ -883,13 +2910,17 @@ async def logs_page():
                     <div class="stat-label">Total Registros</div>
                 </div>
                 <div class="stat-card">
-                    <div class="stat-number">{len([l for l in logs if l['status'] == 'Entrada válida'])}</div>
+                    <div class="stat-number">{len([l for l in logs if l.status in ENTRY_STATUSES])}</div>
                     <div class="stat-label">Entradas Válidas</div>
                 </div>
                 <div class="stat-card">
-                    <div class="stat-number">{len([l for l in logs if l['status'] != 'Entrada válida'])}</div>
+                    <div class="stat-number">{len([l for l in logs if l.status not in AUTHORIZED_STATUSES])}</div>
                     <div class="stat-label">QR Inválidos</div>
                 </div>
+                <div class="stat-card">
+                    <div class="stat-number">{state.scard('yard')}</div>
+                    <div class="stat-label">En el Patio</div>
+                </div>
             </div>
             
             <div class="table-container">
@@ -925,17 +2956,20 @@ async def api_generate_qr(driver_name: str = Form(...)):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
-@app.post("/api/validate-qr")
-async def api_validate_qr(qr_data: str = Form(...)):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
+def validate_qr(qr_data, timestamp, mode="entrada"):
+    # Devuelve (respuesta, entrada de log) sin escribir nada en disco;
+    # sí actualiza la ocupación del patio
     try:
         # Intentar parsear como JSON (datos del QR generado)
         try:
             qr_json = json.loads(qr_data)
+            if not isinstance(qr_json, dict):
+                raise json.JSONDecodeError("No es un objeto", qr_data, 0)
             if "code" in qr_json and "driver_name" in qr_json:
-                qr_code = qr_json["code"]
-                driver_name = qr_json["driver_name"]
+                # El contenido del QR no es de confianza: {"code": 5} es un código
+                # inexistente, no un error del sistema
+                qr_code = str(qr_json["code"])
+                driver_name = str(qr_json["driver_name"])
             else:
                 raise ValueError("Formato de QR inválido")
         except json.JSONDecodeError:
@@ -944,58 +2978,477 @@ async def api_validate_qr(qr_data: str = Form(...)):
             driver_name = "Desconocido"
         
         # Verificar en la base de datos de conductores
-        drivers = load_drivers()
+        driver_info = lookup_driver(qr_code)
         
-        if qr_code in drivers:
-            driver_info = drivers[qr_code]
-            log_entry = {
-                "timestamp": timestamp,
-                "driver_name": driver_info["name"],
-                "qr_code": qr_code,
-                "status": "Entrada válida",
-                "notes": f"QR generado el {driver_info['generated_at']}"
-            }
+        if driver_info is not None and mode == "salida":
+            # La salida se registra aunque el código se haya revocado con el
+            # camión dentro; si no, quedaría en el patio para siempre
+            dwell = yard_exit(qr_code, timestamp)
+            if dwell is None:
+                log_entry = LogEntry(timestamp, driver_info.name, qr_code, "Salida sin entrada",
+                                     "No había entrada registrada para este código")
+            else:
+                log_entry = LogEntry(timestamp, driver_info.name, qr_code, "Salida válida",
+                                     f"Permanencia: {format_dwell(dwell)}")
+            if is_revoked(qr_code):
+                log_entry.notes += f" (código revocado: {revocation_reason(qr_code) or 'sin motivo registrado'})"
             
-            save_log_entry(log_entry)
+            return {
+                "success": True,
+                "driver_name": driver_info.name,
+                "qr_code": qr_code,
+                "mode": mode,
+                "dwell_seconds": dwell,
+                "message": "Salida registrada"
+            }, log_entry
+        elif driver_info is not None and is_revoked(qr_code):
+            reason = revocation_reason(qr_code) or "sin motivo registrado"
+            log_entry = LogEntry(timestamp, driver_info.name, qr_code, "QR revocado",
+                                 f"Código revocado: {reason}")
             
             return {
+                "success": False,
+                "message": "Código QR revocado",
+                "qr_code": qr_code
+            }, log_entry
+        elif driver_info is not None:
+            previous, exited_at = yard_enter(qr_code, driver_info.name, timestamp)
+            notes = f"QR generado el {driver_info.generated_at}"
+            if previous:
+                notes += f" (ya figuraba dentro desde {previous})"
+            if exited_at:
+                notes += f" (ya salió a las {exited_at}; no figura dentro)"
+            
+            # Contrastar con la cita de andén, si el código tiene alguna
+            status = "Entrada válida"
+            result = {
                 "success": True,
-                "driver_name": driver_info["name"],
+                "driver_name": driver_info.name,
                 "qr_code": qr_code,
+                "mode": mode,
                 "message": "Entrada autorizada"
             }
+            arrival, window = check_appointment(qr_code, timestamp)
+            if window is not None:
+                start, end, dock = window
+                result["appointment"] = {"start": start.isoformat(sep=" "), "end": end.isoformat(sep=" "), "dock": dock}
+                notes += f"; cita {start:%Y-%m-%d %H:%M}-{end:%H:%M}" + (f" andén {dock}" if dock else "")
+            if arrival in ("anticipada", "tardía"):
+                status = f"Llegada {arrival}"
+                result["warning"] = f"Llegada {arrival}: cita de {start:%H:%M} a {end:%H:%M}"
+            
+            log_entry = LogEntry(timestamp, driver_info.name, qr_code, status, notes)
+            return result, log_entry
         else:
-            log_entry = {
-                "timestamp": timestamp,
-                "driver_name": driver_name,
-                "qr_code": qr_code,
-                "status": "QR inválido",
-                "notes": "Código no encontrado en la base de datos"
-            }
-            
-            save_log_entry(log_entry)
+            log_entry = LogEntry(timestamp, driver_name, qr_code, "QR inválido",
+                                 "Código no encontrado en la base de datos")
             
             return {
                 "success": False,
                 "message": "Código QR no válido o no registrado",
                 "qr_code": qr_code
-            }
+            }, log_entry
             
     except Exception as e:
-        log_entry = {
-            "timestamp": timestamp,
-            "driver_name": "Error",
-            "qr_code": qr_data[:50],
-            "status": "Error del sistema",
-            "notes": str(e)
-        }
-        
-        save_log_entry(log_entry)
+        log_entry = LogEntry(timestamp, "Error", qr_data[:50], "Error del sistema", str(e))
         
         return {
             "success": False,
             "message": f"Error al procesar el código QR: {str(e)}"
+        }, log_entry
+
+@app.post("/api/validate-qr")
+async def api_validate_qr(qr_data: str = Form(...), event_id: Optional[str] = Form(None),
+                          mode: str = Form("entrada")):
+    if mode not in SCAN_MODES:
+        raise HTTPException(status_code=400, detail="Modo de escaneo inválido")
+    
+    # Un reintento del mismo evento no se vuelve a validar: el resultado
+    # calculado ahora (quizá con otro modo) no sería el que quedó registrado
+    if event_id and not register_event(event_id):
+        return {
+            "success": False,
+            "duplicate": True,
+            "event_id": event_id,
+            "message": "Este escaneo ya fue registrado"
         }
+    
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    result, log_entry = validate_qr(qr_data, timestamp, mode)
+    log_entry.event_id = event_id
+    save_log_entry(log_entry)
+    return result
+
+def require_admin(request):
+    if ADMIN_TOKEN is not None:
+        token = request.headers.get("X-Admin-Token") or ""
+        if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            raise HTTPException(status_code=401, detail="Token de administración inválido")
+    elif not request.client or request.client.host not in ADMIN_LOCAL_HOSTS:
+        raise HTTPException(status_code=403, detail="Sin ADMIN_TOKEN solo se acepta desde localhost")
+
+@app.post("/api/admin/revoke")
+async def api_revoke_qr(request: Request, qr_code: str = Form(...), reason: str = Form("")):
+    require_admin(request)
+    qr_code = qr_code.strip()
+    if lookup_driver(qr_code) is None:
+        return {"success": False, "message": "Código QR no registrado"}
+    
+    refresh_state(force=True)
+    if state.sismember("revoked", qr_code):
+        return {"success": False, "message": "El código QR ya está revocado"}
+    
+    version = record_driver_change("revoke", qr_code, reason=reason.strip())
+    set_revoked(qr_code, reason.strip())
+    return {"success": True, "qr_code": qr_code, "version": version}
+
+@app.post("/api/admin/reinstate")
+async def api_reinstate_qr(request: Request, qr_code: str = Form(...)):
+    require_admin(request)
+    qr_code = qr_code.strip()
+    driver = lookup_driver(qr_code)
+    
+    refresh_state(force=True)
+    if driver is None or not state.sismember("revoked", qr_code):
+        return {"success": False, "message": "El código QR no está revocado"}
+    
+    version = record_driver_change("reinstate", qr_code, driver.to_dict())
+    clear_revoked(qr_code)
+    return {"success": True, "qr_code": qr_code, "version": version}
+
+@app.get("/api/admin/gc")
+async def api_gc_report(request: Request):
+    require_admin(request)
+    return {"success": True, "report": last_gc_report}
+
+@app.post("/api/admin/gc")
+async def api_run_gc(request: Request):
+    require_admin(request)
+    report = await run_garbage_collection()
+    if report is None:
+        return {"success": False, "message": "Ya hay una recolección en curso"}
+    return {"success": True, "report": report}
+
+class ScanEvent(BaseModel):
+    event_id: str
+    qr_data: str
+    scanned_at: Optional[str] = None
+    gate: Optional[str] = None
+    mode: Literal["entrada", "salida"] = "entrada"
+
+class SyncRequest(BaseModel):
+    events: List[ScanEvent] = []
+    since: Optional[int] = None
+
+def sync_timestamp(scanned_at):
+    # Conservar la hora real del escaneo si viene en el formato de los logs y
+    # es plausible: mueve la ocupación, las citas y la analítica
+    now = datetime.now().replace(microsecond=0)
+    if not scanned_at:
+        return now.strftime("%Y-%m-%d %H:%M:%S"), ""
+    try:
+        moment = datetime.strptime(scanned_at, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return now.strftime("%Y-%m-%d %H:%M:%S"), ""
+    if (moment > now + timedelta(seconds=SYNC_CLOCK_SKEW_SECONDS)
+            or moment < now - timedelta(hours=SYNC_MAX_EVENT_AGE_HOURS)):
+        return now.strftime("%Y-%m-%d %H:%M:%S"), f"; hora del dispositivo {scanned_at} fuera de rango"
+    return min(moment, now).strftime("%Y-%m-%d %H:%M:%S"), ""
+
+@app.post("/api/sync")
+async def api_sync(request: Request, sync_request: SyncRequest):
+    if len(sync_request.events) > SYNC_MAX_EVENTS:
+        raise HTTPException(status_code=413, detail=f"Máximo {SYNC_MAX_EVENTS} eventos por solicitud")
+    
+    accepted = []
+    duplicates = []
+    throttled = []
+    retry_after = 0
+    results = {}
+    log_entries = []
+    bucket = getattr(request.state, "rate_bucket", None)
+    
+    for i, event in enumerate(sync_request.events):
+        # La solicitud ya pagó la ficha del primer evento; sin fichas para el
+        # resto, se devuelven como pendientes y la caseta los reenvía después
+        if i and bucket is not None:
+            retry_after = bucket.consume(time.monotonic())
+            if retry_after:
+                throttled = [pending.event_id for pending in sync_request.events[i:]]
+                break
+        
+        # SADD es atómico: solo un nodo procesa cada evento
+        if not register_event(event.event_id):
+            duplicates.append(event.event_id)
+            continue
+        
+        timestamp, clock_note = sync_timestamp(event.scanned_at)
+        result, log_entry = validate_qr(event.qr_data, timestamp, event.mode)
+        log_entry.event_id = event.event_id
+        log_entry.gate = event.gate
+        log_entry.notes = f"{log_entry.notes} (sincronizado desde cola local{clock_note})"
+        
+        log_entries.append(log_entry)
+        accepted.append(event.event_id)
+        results[event.event_id] = result
+    
+    if log_entries:
+        save_log_entries(log_entries)
+    
+    return {
+        "success": True,
+        "accepted": accepted,
+        "duplicates": duplicates,
+        "throttled": throttled,
+        "retry_after": math.ceil(retry_after),
+        "results": results,
+        **driver_changes_since(sync_request.since)
+    }
+
+@app.get("/api/occupancy")
+async def api_occupancy():
+    now = datetime.now()
+    inside = []
+    # Dos viajes al backend sin importar cuántos camiones haya: el conjunto
+    # y un MGET con el detalle de todos
+    codes = sorted(state.smembers("yard"))
+    for code, entry in zip(codes, state.mget(*[f"yard:{code}" for code in codes])):
+        if entry is None:
+            continue  # salió entre la lectura del conjunto y la del detalle
+        entry = serializer.loads(entry)
+        minutes = (now - parse_log_timestamp(entry["entered_at"])).total_seconds() / 60
+        inside.append({"qr_code": code, **entry, "minutes_inside": max(0, round(minutes))})
+    inside.sort(key=lambda item: item["entered_at"])
+    
+    return {"success": True, "count": len(inside), "inside": inside}
+
+@app.get("/api/occupancy/{qr_code}")
+async def api_driver_occupancy(qr_code: str):
+    entry = state.get(f"yard:{qr_code}")
+    stats = load_dwell_stats(qr_code, state)
+    return {
+        "success": True,
+        "qr_code": qr_code,
+        "inside": entry is not None,
+        "entered_at": serializer.loads(entry)["entered_at"] if entry else None,
+        "visits": stats["visits"],
+        "average_dwell_minutes": round(stats["total_seconds"] / stats["visits"] / 60) if stats["visits"] else None,
+        "last_dwell_minutes": round(stats["last_seconds"] / 60) if stats["visits"] else None
+    }
+
+@app.post("/api/appointments/upload")
+async def api_upload_appointments(file: UploadFile = File(...), replace: bool = Form(False)):
+    global appointments, appointments_mtime
+    # CSV con columnas qr_code,start,end[,dock]; se valida completo antes de guardar
+    content = (await file.read()).decode("utf-8-sig")
+    reader = csv.DictReader(io.StringIO(content))
+    if not reader.fieldnames or not {"qr_code", "start", "end"} <= set(reader.fieldnames):
+        return {"success": False, "message": "El CSV debe tener las columnas qr_code, start y end"}
+    
+    rows = []
+    errors = []
+    for line, row in enumerate(reader, start=2):
+        try:
+            rows.append(parse_appointment_row(row))
+        except (ValueError, KeyError, AttributeError) as e:
+            errors.append(f"Línea {line}: {e}")
+    if errors:
+        return {"success": False, "message": "Citas inválidas, no se guardó nada", "errors": errors[:50]}
+    
+    # El índice se construye antes de tocar el archivo: si falla, no queda
+    # guardado. Las citas ya vencidas (existentes o nuevas) se descartan
+    cutoff = appointments_cutoff()
+    with open(APPOINTMENTS_LOCK_FILE, 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # otra carga en otro worker
+        index = AppointmentIndex()
+        if not replace and os.path.exists(APPOINTMENTS_FILE):
+            load_appointments_file(index)
+        for code, start, end, dock in rows:
+            if end >= cutoff:
+                index.add(code, start, end, dock)
+        try:
+            index.build()
+        except (TypeError, ValueError) as e:
+            return {"success": False, "message": f"Citas inválidas, no se guardó nada: {e}"}
+        save_appointments_file(index)
+    
+    appointments = index
+    appointments_mtime = os.path.getmtime(APPOINTMENTS_FILE)
+    return {"success": True, "loaded": len(rows), "total": len(appointments)}
+
+@app.get("/api/appointments/{qr_code}")
+async def api_driver_appointments(qr_code: str):
+    return {
+        "success": True,
+        "qr_code": qr_code,
+        "appointments": [
+            {"start": start.isoformat(sep=" "), "end": end.isoformat(sep=" "), "dock": dock}
+            for start, end, dock in appointments.windows.get(qr_code, [])
+        ]
+    }
+
+@app.get("/api/analytics")
+async def api_analytics(group_by: Optional[str] = None, start: Optional[str] = None,
+                        end: Optional[str] = None, qr_code: Optional[str] = None,
+                        limit: int = ANALYTICS_GROUP_LIMIT):
+    if group_by is not None and group_by not in ANALYTICS_GROUPS:
+        raise HTTPException(status_code=400, detail="Agrupación inválida: use driver, hour, day o status")
+    try:
+        # start incluido, end excluido: start=2025-06-01&end=2025-07-01 es junio completo
+        start_at = parse_local_time(start) if start else None
+        end_at = parse_local_time(end) if end else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha inválida (use AAAA-MM-DD o AAAA-MM-DD HH:MM:SS)")
+    
+    frame = log_columns.refresh()
+    if start_at is not None:
+        frame = frame[frame["timestamp"] >= start_at]
+    if end_at is not None:
+        frame = frame[frame["timestamp"] < end_at]
+    if qr_code:
+        frame = frame[frame["qr_code"] == qr_code]
+    
+    return {
+        "success": True,
+        "group_by": group_by,
+        "start": start,
+        "end": end,
+        **analyze_logs(frame, group_by, max(1, limit))
+    }
+
+@app.get("/api/drivers/changes")
+async def api_driver_changes(since: Optional[int] = None, limit: int = DRIVER_CHANGES_PAGE_SIZE):
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit debe ser mayor que cero")
+    return driver_changes_since(since, min(limit, DRIVER_CHANGES_PAGE_SIZE))
+
+@app.get("/api/export/{dataset}")
+async def api_export(dataset: str):
+    # Exportación legible (indentada) de los archivos de datos
+    exports = {"drivers": DRIVERS_FILE, "logs": LOGS_FILE}
+    if dataset not in exports:
+        raise HTTPException(status_code=404, detail="Conjunto de datos no encontrado")
+    
+    return Response(
+        content=serializer.dumps(read_json(exports[dataset]), pretty=True),
+        media_type="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.json"'}
+    )
+
+# Salud y apagado ordenado
+draining = False
+drained = False
+drain_task = None
+caches_warm = False
+
+def storage_status():
+    files = {path: os.access(path, os.R_OK | os.W_OK)
+             for path in (DRIVERS_FILE, LOGS_FILE, LOGS_CSV_FILE, DRIVER_CHANGES_FILE)}
+    return {"ok": all(files.values()) and os.access("data", os.W_OK), "files": files}
+
+def state_status():
+    backend = "shared" if state.shared else "memory"
+    try:
+        state.get("yard:initialized")
+    except (OSError, RuntimeError) as e:
+        return {"ok": False, "backend": backend, "error": str(e)}
+    return {"ok": True, "backend": backend}
+
+def cache_status():
+    return {
+        "ok": caches_warm,
+        "startup": startup_report,
+        "driver_version": driver_change_versions[-1] if driver_change_versions else driver_changes_base,
+        "revocations": revocation_filter.count,
+        "appointments": len(appointments),
+        "analytics_rows": len(log_columns.frame)
+    }
+
+async def warm_caches():
+    # Citas y columnas de analítica se cargan antes de declararse listo
+    global caches_warm
+    await asyncio.get_event_loop().run_in_executor(None, refresh_appointments)
+    log_columns.refresh()
+    caches_warm = True
+
+async def stop_background_jobs():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if snapshot_write is not None:
+        await asyncio.gather(snapshot_write, return_exceptions=True)
+
+async def drain(exit_process=False):
+    # Rechaza escaneos nuevos (503), espera los que están en curso, detiene
+    # las tareas de fondo y deja un snapshot final para el siguiente arranque
+    global draining, drained
+    draining = True
+    print("🚦 Drenando: no se aceptan escaneos nuevos")
+    if exit_process:
+        await asyncio.sleep(DRAIN_GRACE_SECONDS)
+    
+    deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+    while requests_in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    
+    await stop_background_jobs()
+    if not state.shared:
+        try:
+            await run_snapshot()
+        except Exception as e:
+            print(f"⚠️ Error al escribir el snapshot final: {e}")
+    drained = True
+    print("✅ Drenado completo")
+    
+    if exit_process:
+        # Apagado normal de uvicorn (el hook de shutdown ya no repite el drenado)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "draining" if draining else "ok",
+            "uptime_seconds": round(time.monotonic() - startup_began)}
+
+@app.get("/readyz")
+async def readyz():
+    checks = {"storage": storage_status(), "state": state_status(), "caches": cache_status()}
+    ready = not draining and all(check["ok"] for check in checks.values())
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={"ready": ready, "draining": draining, **checks})
+
+@app.post("/api/admin/drain")
+async def api_drain(request: Request):
+    global drain_task
+    require_admin(request)
+    if draining:
+        return {"success": False, "message": "El servidor ya se está drenando"}
+    drain_task = asyncio.create_task(drain(exit_process=True))
+    return {
+        "success": True,
+        "message": "Drenando: el proceso terminará al completar los escaneos en curso",
+        "grace_seconds": DRAIN_GRACE_SECONDS,
+        "timeout_seconds": DRAIN_TIMEOUT_SECONDS
+    }
+
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background_jobs():
+    background_tasks.append(asyncio.create_task(warm_caches()))
+    background_tasks.append(asyncio.create_task(garbage_collection_loop()))
+    background_tasks.append(asyncio.create_task(appointments_loop()))
+    if not state.shared:
+        background_tasks.append(asyncio.create_task(snapshot_loop()))
+
+@app.on_event("shutdown")
+async def stop_gracefully():
+    # SIGTERM de uvicorn: ya dejó de aceptar conexiones y esperó las abiertas
+    if drain_task is not None and not drain_task.done():
+        drain_task.cancel()
+    if not drained:
+        await drain()
 
 # Servir archivos estáticos
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -1010,4 +3463,8 @@ if __name__ == "__main__":
     print("🏠 Inicio: http://localhost:8000")
     print("\n⚡ Iniciando servidor...")
     
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # La recarga automática exige pasar la app como cadena de importación;
+    # sin ella se usa el objeto ya importado para no cargar el estado dos veces
+    reload = os.environ.get("RELOAD") == "1"
+    uvicorn.run("main:app" if reload else app, host="0.0.0.0", port=8000, reload=reload,
+                timeout_graceful_shutdown=DRAIN_TIMEOUT_SECONDS)
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""Reproduce el tráfico real de escaneos contra una instancia local del servidor.
+
+Lee data/entry_logs.csv (o entry_logs.json), respeta los intervalos reales
+entre escaneos a la velocidad elegida y envía cada uno a /api/validate-qr.
+Reporta latencia (p50/p95/p99) y tasa de error por intervalo del horario
+original, para ver cómo responde el servidor a los picos de cambio de turno.
+
+Los escaneos se registran en el servidor de destino: usar una instancia de
+prueba con una copia de data/, nunca la de producción.
+
+Uso:
+    python backend/replay.py --speed 10
+    python backend/replay.py data/entry_logs.json --url http://localhost:8001 --speed 100 \\
+        --start "2025-06-02 06:00:00" --end "2025-06-02 09:00:00" --bucket 300
+"""
+import argparse
+import csv
+import http.client
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlparse
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Mismos estados que EXIT_STATUSES en main.py: se reproducen en modo salida
+EXIT_STATUSES = ("Salida válida", "Salida sin entrada")
+
+
+def load_events(path, start=None, end=None):
+    if path.endswith(".json"):
+        with open(path, "rb") as f:
+            rows = json.load(f)
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+
+    events = []
+    for row in rows:
+        try:
+            timestamp = datetime.strptime(row["timestamp"], TIMESTAMP_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            continue
+        if (start and timestamp < start) or (end and timestamp >= end):
+            continue
+        events.append({
+            "timestamp": timestamp,
+            "qr_data": row.get("qr_code") or "",
+            "mode": "salida" if row.get("status") in EXIT_STATUSES else "entrada",
+            "gate": row.get("gate")
+        })
+    # Los escaneos sincronizados desde la cola local pueden venir fuera de orden
+    events.sort(key=lambda event: event["timestamp"])
+    return events
+
+
+class Client:
+    # Una conexión persistente por hilo
+    def __init__(self, url, timeout):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def post(self, path, fields, headers):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request("POST", path, urlencode(fields), {
+                "Content-Type": "application/x-www-form-urlencoded", **headers
+            })
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def replay(events, client, speed, bucket_seconds, concurrency):
+    # La latencia se mide desde la hora programada del envío, no desde que un
+    # hilo quedó libre: si el cliente se atrasa, el atraso cuenta como espera
+    results = []
+    lock = threading.Lock()
+    first = events[0]["timestamp"]
+
+    def send(event, scheduled):
+        headers = {"X-Gate-Id": event["gate"]} if event["gate"] else {}
+        status = client.post("/api/validate-qr", {
+            "qr_data": event["qr_data"],
+            "event_id": f"replay-{uuid.uuid4().hex}",
+            "mode": event["mode"]
+        }, headers)
+        latency = time.perf_counter() - scheduled
+        bucket = int((event["timestamp"] - first).total_seconds() // bucket_seconds)
+        with lock:
+            results.append((bucket, latency, status))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for event in events:
+            scheduled = started + (event["timestamp"] - first).total_seconds() / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, event, scheduled)
+    return results, time.perf_counter() - started
+
+
+def summarize(latencies, statuses):
+    latencies = sorted(latencies)
+    throttled = sum(1 for status in statuses if status == 429)
+    errors = sum(1 for status in statuses if status is None or status >= 500)
+    return {
+        "requests": len(statuses),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "throttled": throttled,
+        "errors": errors,
+        "error_rate": round(errors / len(statuses), 4) if statuses else 0.0
+    }
+
+
+def build_report(results, first, bucket_seconds):
+    buckets = {}
+    for bucket, latency, status in results:
+        latencies, statuses = buckets.setdefault(bucket, ([], []))
+        latencies.append(latency)
+        statuses.append(status)
+
+    report = []
+    for bucket in sorted(buckets):
+        start = first + timedelta(seconds=bucket * bucket_seconds)
+        report.append({"start": start.strftime(TIMESTAMP_FORMAT), **summarize(*buckets[bucket])})
+    total = summarize([latency for _, latency, _ in results], [status for _, _, status in results])
+    return report, total
+
+
+def print_report(report, total, elapsed, speed):
+    print(f"{'inicio (horario original)':<26}{'envíos':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'429':>6}{'errores':>9}{'% error':>9}")
+    for row in report + [{"start": "total", **total}]:
+        print(f"{row['start']:<26}{row['requests']:>8}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+              f"{row['p99_ms']:>9.1f}{row['throttled']:>6}{row['errors']:>9}{row['error_rate'] * 100:>8.1f}%")
+    print(f"\n{total['requests']} escaneos en {elapsed:.1f} s a {speed:g}x "
+          f"({total['requests'] / elapsed if elapsed else 0:.1f} solicitudes/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", nargs="?", default="data/entry_logs.csv",
+                        help="entry_logs.csv o entry_logs.json")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = tiempo real, 10, 100...")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="solo escaneos desde esta hora")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="solo escaneos antes de esta hora")
+    parser.add_argument("--bucket", type=int, default=60, help="segundos del horario original por fila")
+    parser.add_argument("--concurrency", type=int, default=64, help="solicitudes simultáneas máximas")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--json", action="store_true", help="imprimir el reporte en JSON")
+    args = parser.parse_args()
+
+    if args.speed <= 0 or args.bucket <= 0:
+        parser.error("--speed y --bucket deben ser positivos")
+    if not os.path.exists(args.source):
+        parser.error(f"no existe {args.source}")
+
+    events = load_events(args.source, args.start, args.end)
+    if not events:
+        parser.error("no hay escaneos que reproducir en el rango indicado")
+    span = (events[-1]["timestamp"] - events[0]["timestamp"]).total_seconds()
+    if not args.json:
+        print(f"▶️ {len(events)} escaneos ({span / 60:.0f} min de tráfico) a {args.speed:g}x: "
+              f"~{span / args.speed / 60:.1f} min contra {args.url}\n")
+
+    results, elapsed = replay(events, Client(args.url, args.timeout), args.speed, args.bucket, args.concurrency)
+    report, total = build_report(results, events[0]["timestamp"], args.bucket)
+    if args.json:
+        print(json.dumps({"speed": args.speed, "elapsed_seconds": round(elapsed, 3),
+                          "buckets": report, "total": total}, ensure_ascii=False, indent=2))
+    else:
+        print_report(report, total, elapsed, args.speed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+// Decodificación de códigos QR fuera del hilo de la interfaz.
+// Recibe cuadros del video como ImageBitmap (transferidos) y responde con
+// el texto del primer código QR encontrado, o null si no hay ninguno.
+// Usa BarcodeDetector del navegador: no descarga nada, funciona sin conexión.
+
+let detector = null;
+
+async function init() {
+    if (!('BarcodeDetector' in self)) {
+        return false;
+    }
+    const formats = await BarcodeDetector.getSupportedFormats();
+    if (!formats.includes('qr_code')) {
+        return false;
+    }
+    detector = new BarcodeDetector({ formats: ['qr_code'] });
+    return true;
+}
+
+const ready = init().catch(() => false);
+
+ready.then(supported => self.postMessage({ type: 'ready', supported }));
+
+self.onmessage = async (event) => {
+    const frame = event.data;
+    let value = null;
+    try {
+        if (await ready) {
+            const codes = await detector.detect(frame);
+            value = codes.length ? codes[0].rawValue : null;
+        }
+    } catch (error) {
+        // Cuadro ilegible: se trata como "sin código"
+    } finally {
+        frame.close();
+    }
+    self.postMessage({ type: 'frame', value });
+};